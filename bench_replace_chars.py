@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+microbenchmark of clean_parallel.replace_chars() against the per-char concatenation it replaced,
+and against str.translate() with a mapping table.
+'''
+
+import random
+import timeit
+from argparse import ArgumentParser
+from clean_parallel import UNHAPPY_CHARS, replace_chars, restore_chars
+
+
+TABLE = str.maketrans(UNHAPPY_CHARS)
+
+
+def replace_chars_loop(text):
+    ret = ''
+    for w in text:
+        if w in UNHAPPY_CHARS:
+            ret += UNHAPPY_CHARS[w]
+        else:
+            ret += w
+    return ret
+
+
+def replace_chars_translate(text):
+    return text.translate(TABLE)
+
+
+def parse_args():
+    p = ArgumentParser(description='replace_chars benchmark')
+    p.add_argument('--lengths', default='100,1000,10000', metavar='INTS',
+        help='comma-separated lengths of lines (default: 100,1000,10000)')
+    p.add_argument('--density', default=0.01, metavar='FLOAT', type=float,
+        help='ratio of unhappy chars in lines (default: 0.01)')
+    p.add_argument('--repeat', default=5, metavar='INT', type=int,
+        help='number of repetitions (default: 5)')
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(0)
+    unhappy = ''.join(UNHAPPY_CHARS)
+
+    print('length\tloop(us)\ttranslate(us)\treplace_chars(us)\tspeedup')
+    for length in (int(x) for x in args.lengths.split(',')):
+        text = ''.join(
+            random.choice(unhappy) if random.random() < args.density else random.choice('abcdefghij ')
+            for _ in range(length))
+        assert replace_chars(text) == replace_chars_loop(text) == replace_chars_translate(text)
+        assert restore_chars(replace_chars(text)) == text
+        number = max(1, 100000 // length)
+        times = [
+            min(timeit.repeat(lambda: f(text), number=number, repeat=args.repeat)) / number
+            for f in (replace_chars_loop, replace_chars_translate, replace_chars)]
+        print('%d\t%.2f\t%.2f\t%.2f\t%.1fx' % ((length,) + tuple(t * 1e6 for t in times) + (times[0] / times[2],)))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,19 @@
 # -*- coding: utf-8 -*-
 
 
+import hashlib
+import random
+import multiprocessing
+import struct
 import sys
 import re
+import time
 import unicodedata
+import zlib
 from argparse import ArgumentParser
+from array import array
+from functools import lru_cache
+from itertools import islice
 
 
 UNHAPPY_CHARS = {
@@ -20,6 +29,20 @@ UNHAPPY_CHARS = {
     '|': '-BAR-',
 }
 
+# replacements contain no unhappy chars, so they can be applied one by one
+ESCAPE_ITEMS = list(UNHAPPY_CHARS.items())
+UNESCAPE_PATTERN = re.compile('|'.join(re.escape(v) for v in UNHAPPY_CHARS.values()))
+UNESCAPE_CHARS = {v: k for k, v in UNHAPPY_CHARS.items()}
+
+
+# bytes of shingles of min-hash
+SHINGLE_SIZE = 5
+
+
+# arguments and filter rules shared with forked worker processes
+_args = None
+_rules = None
+
 
 # trim and normalize spaces
 def normalize_spaces(text):
@@ -30,33 +53,262 @@ def normalize_spaces(text):
 
 # replace unhappy chars 
 def replace_chars(text):
-    global UNHAPPY_CHARS
-    ret = ''
-    for w in text:
-        if w in UNHAPPY_CHARS:
-            ret += UNHAPPY_CHARS[w]
-        else:
-            ret += w
+    for c, r in ESCAPE_ITEMS:
+        if c in text:
+            text = text.replace(c, r)
+    return text
+
+
+# restore unhappy chars replaced by replace_chars()
+def restore_chars(text):
+    return UNESCAPE_PATTERN.sub(lambda m: UNESCAPE_CHARS[m.group(0)], text)
+
+
+# ratio of chars matching the pattern among non-space chars
+def charset_ratio(text, pattern):
+    n = len(text) - text.count(' ')
+    return len(pattern.findall(text)) / n if n else 0.0
+
+
+# make filter rules (name, test) in order of cost.
+# test(text_f, text_e, lf, le) returns True if the pair is kept, where lf and le are #words.
+def make_rules(args):
+    rules = []
+    if args.drop_identical:
+        rules.append((0, 'identical', lambda f, e, lf, le: f != e))
+    rules.append((1, 'min', lambda f, e, lf, le: lf >= args.n_min and le >= args.n_min))
+    rules.append((1, 'max', lambda f, e, lf, le: lf <= args.n_max and le <= args.n_max))
+    rules.append((1, 'ratio', lambda f, e, lf, le: max(lf/le, le/lf) <= args.ratio))
+    if args.charset1 is not None:
+        p1 = re.compile('[%s]' % args.charset1)
+        rules.append((10, 'charset1', lambda f, e, lf, le: charset_ratio(f, p1) >= args.charset_ratio))
+    if args.charset2 is not None:
+        p2 = re.compile('[%s]' % args.charset2)
+        rules.append((10, 'charset2', lambda f, e, lf, le: charset_ratio(e, p2) >= args.charset_ratio))
+    rules.sort(key=lambda x: x[0])
+    return [(name, test) for cost, name, test in rules]
+
+
+class Filter:
+    '''
+    apply filter rules until the first rule rejecting a pair,
+    counting rejected pairs and time spent for each rule.
+    '''
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.rejects = {name: 0 for name, test in rules}
+        self.seconds = {name: 0.0 for name, test in rules}
+
+    def check(self, text_f, text_e):
+        lf = len(text_f.split())
+        le = len(text_e.split())
+        for name, test in self.rules:
+            begin = time.perf_counter()
+            ok = test(text_f, text_e, lf, le)
+            self.seconds[name] += time.perf_counter() - begin
+            if not ok:
+                self.rejects[name] += 1
+                return False
+        return True
+
+
+# fixed random orders of bins borrowed by each empty bin of minhash()
+@lru_cache(maxsize=None)
+def densify_orders(k):
+    rand = random.Random(k)
+    ret = []
+    for i in range(k):
+        order = list(range(k))
+        rand.shuffle(order)
+        ret.append(order)
     return ret
 
 
-# check #words in the text
-def check_length(text_f, text_e, args):
-    lf = len(text_f.split())
-    le = len(text_e.split())
-    if lf < args.n_min: return False
-    if le < args.n_min: return False
-    if lf > args.n_max: return False
-    if le > args.n_max: return False
-    r = max(lf/le, le/lf)
-    if r > args.ratio: return False
-    return True
+# min-hash signature of k values by one permutation hashing:
+# shingles are hashed once and divided into k bins, and each value is the minimum in a bin.
+# empty bins borrow the value of the first non-empty bin in their random orders.
+def minhash(shingles, k):
+    EMPTY = 1 << 32
+    sig = [EMPTY] * k
+    for x in shingles:
+        x = zlib.crc32(x)
+        b = x % k
+        if x < sig[b]:
+            sig[b] = x
+    if EMPTY in sig:
+        orders = densify_orders(k)
+        filled = list(sig)
+        for i in range(k):
+            if sig[i] == EMPTY:
+                for j in orders[i]:
+                    if sig[j] != EMPTY:
+                        filled[i] = sig[j]
+                        break
+        sig = filled
+    return sig
+
+
+def hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+# compute the 64-bit hash of the normalized pair, and LSH band keys of its min-hash signature
+def dedup_keys(text_f, text_e, args):
+    text = ('%s\t%s' % (text_f, text_e)).lower().encode('utf-8')
+    exact = hash64(text)
+    if not args.near_dup:
+        return exact, None
+
+    n = SHINGLE_SIZE
+    shingles = {text[i:i+n] for i in range(max(1, len(text) - n + 1))}
+    rows = args.lsh_rows
+    sig = minhash(shingles, args.lsh_bands * rows)
+    bands = [
+        hash64(struct.pack('<%dI' % (rows + 1), b, *sig[b :: args.lsh_bands]))
+        for b in range(args.lsh_bands)]
+    return exact, bands
+
+
+# clean a sentence pair, or return None if it is ignored
+def clean_pair(text_f, text_e, flt):
+    text_f = normalize_spaces(text_f)
+    text_e = normalize_spaces(text_e)
+    text_f = replace_chars(text_f)
+    text_e = replace_chars(text_e)
+    if flt.check(text_f, text_e):
+        return text_f, text_e
+    return None
+
+
+# returns list of (text_f, text_e, dedup keys or None), or None for each ignored pair,
+# and reject counts and seconds of filter rules in the chunk
+def clean_chunk(chunk):
+    flt = Filter(_rules)
+    ret = []
+    for text_f, text_e in chunk:
+        pair = clean_pair(text_f, text_e, flt)
+        if pair is not None:
+            keys = dedup_keys(pair[0], pair[1], _args) if _args.dedup else None
+            pair = (pair[0], pair[1], keys)
+        ret.append(pair)
+    return ret, flt.rejects, flt.seconds
+
+
+class HashSet:
+    '''
+    set of 64-bit hashes in an open addressing table of array('Q').
+    the table grows up to max_bytes, and then new hashes are dropped.
+    '''
+
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, max_bytes):
+        self.max_size = HashSet.INITIAL_SIZE
+        while self.max_size * 2 * 8 <= max_bytes:
+            self.max_size *= 2
+        self.dropped = 0
+        self.__alloc(HashSet.INITIAL_SIZE)
+
+    def __alloc(self, size):
+        self.__table = array('Q', bytes(8 * size))
+        self.__mask = size - 1
+        self.__limit = size * 2 // 3
+        self.__count = 0
+
+    def __find(self, h):
+        # returns the slot of h, or the empty slot to put h
+        table = self.__table
+        mask = self.__mask
+        i = (h >> 32) & mask
+        while table[i] != 0 and table[i] != h:
+            i = (i + 1) & mask
+        return i
+
+    def __contains__(self, h):
+        h = h or 1
+        return self.__table[self.__find(h)] == h
+
+    def add(self, h):
+        '''
+        add a hash.
+        @return (bool) True if h is already in the set
+        '''
+        h = h or 1
+        i = self.__find(h)
+        if self.__table[i] == h:
+            return True
+        if self.__count >= self.__limit:
+            if len(self.__table) >= self.max_size:
+                self.dropped += 1
+                return False
+            old = self.__table
+            self.__alloc(len(old) * 2)
+            for x in old:
+                if x != 0:
+                    self.__table[self.__find(x)] = x
+                    self.__count += 1
+            i = self.__find(h)
+        self.__table[i] = h
+        self.__count += 1
+        return False
+
+
+class Dedup:
+    '''
+    remove exact duplicates by 64-bit hashes of normalized pairs,
+    and near duplicates sharing any LSH band of min-hash signatures with a stored pair.
+    '''
+
+    def __init__(self, args):
+        memory = args.dedup_memory << 20
+        if args.near_dup:
+            self.exact = HashSet(memory // (args.lsh_bands + 1))
+            self.bands = HashSet(memory * args.lsh_bands // (args.lsh_bands + 1))
+        else:
+            self.exact = HashSet(memory)
+            self.bands = None
+        self.exact_removed = 0
+        self.near_removed = 0
+
+    def dropped(self):
+        return self.exact.dropped + (self.bands.dropped if self.bands is not None else 0)
+
+    def check(self, keys):
+        '''
+        @return (bool) True if the pair is a duplicate
+        '''
+        exact, bands = keys
+        if self.exact.add(exact):
+            self.exact_removed += 1
+            return True
+        if bands is not None:
+            if any(b in self.bands for b in bands):
+                self.near_removed += 1
+                return True
+            for b in bands:
+                self.bands.add(b)
+        return False
+
+
+def chunks(pairs, size):
+    while True:
+        chunk = list(islice(pairs, size))
+        if not chunk:
+            return
+        yield chunk
 
 
 def parse_args():
     DEFAULT_N_MIN = 1
     DEFAULT_N_MAX = 80
     DEFAULT_RATIO = 9.0
+    DEFAULT_WORKERS = 1
+    DEFAULT_CHUNK = 10000
+    DEFAULT_LSH_BANDS = 20
+    DEFAULT_LSH_ROWS = 5
+    DEFAULT_DEDUP_MEMORY = 1024
+    DEFAULT_CHARSET_RATIO = 0.5
 
     p = ArgumentParser()
 
@@ -70,6 +322,29 @@ def parse_args():
         help='maximum #words per line (default: %d)' % DEFAULT_N_MAX)
     p.add_argument('--ratio', dest='ratio', default=DEFAULT_RATIO, metavar='FLOAT', type=float,
         help='upper bound of the ratio between lengths of parallel sentence (default: %f)' % DEFAULT_RATIO)
+    p.add_argument('--drop-identical', dest='drop_identical', action='store_true',
+        help='remove pairs of which both sides are the same')
+    p.add_argument('--charset1', default=None, metavar='CHARS',
+        help='regex character class of expected chars in file 1, e.g. "a-zA-Z"')
+    p.add_argument('--charset2', default=None, metavar='CHARS',
+        help='regex character class of expected chars in file 2, e.g. "\u3040-\u30ff\u4e00-\u9fff"')
+    p.add_argument('--charset-ratio', dest='charset_ratio', default=DEFAULT_CHARSET_RATIO, metavar='FLOAT', type=float,
+        help='minimum ratio of expected chars among non-space chars (default: %f)' % DEFAULT_CHARSET_RATIO)
+    p.add_argument('--workers', default=DEFAULT_WORKERS, metavar='INT', type=int,
+        help='number of worker processes cleaning sentence pairs (default: %d)' % DEFAULT_WORKERS)
+    p.add_argument('--chunk', default=DEFAULT_CHUNK, metavar='INT', type=int,
+        help='number of sentence pairs sent to a worker at once (default: %d)' % DEFAULT_CHUNK)
+    p.add_argument('--dedup', action='store_true',
+        help='remove duplicated pairs (compared in lowercase)')
+    p.add_argument('--near-dup', dest='near_dup', action='store_true',
+        help='also remove near duplicates by min-hash of %d-byte shingles (implies --dedup)' % SHINGLE_SIZE)
+    p.add_argument('--lsh-bands', dest='lsh_bands', default=DEFAULT_LSH_BANDS, metavar='INT', type=int,
+        help='number of LSH bands of min-hash (default: %d)' % DEFAULT_LSH_BANDS)
+    p.add_argument('--lsh-rows', dest='lsh_rows', default=DEFAULT_LSH_ROWS, metavar='INT', type=int,
+        help='number of min-hash values in a band; pairs of Jaccard similarity > about ' + \
+            '(1/bands)^(1/rows) are removed (default: %d)' % DEFAULT_LSH_ROWS)
+    p.add_argument('--dedup-memory', dest='dedup_memory', default=DEFAULT_DEDUP_MEMORY, metavar='MB', type=int,
+        help='upper bound of memory for hashes; hashes beyond it are not stored (default: %d)' % DEFAULT_DEDUP_MEMORY)
     
     args = p.parse_args()
     
@@ -79,15 +354,28 @@ def parse_args():
         if (args.n_max < 1): raise ValueError('you must set --nmax >= 1')
         if (args.ratio < 1.0): raise ValueError('you must set --ratio >= 1.0')
         if (args.n_max < args.n_min): raise ValueError('you must set --nmax >= --nmin')
+        if (args.workers < 1): raise ValueError('you must set --workers >= 1')
+        if (args.chunk < 1): raise ValueError('you must set --chunk >= 1')
+        if (args.lsh_bands < 1): raise ValueError('you must set --lsh-bands >= 1')
+        if (args.lsh_rows < 1): raise ValueError('you must set --lsh-rows >= 1')
+        if (args.dedup_memory < 1): raise ValueError('you must set --dedup-memory >= 1')
+        if (args.charset_ratio < 0.0 or args.charset_ratio > 1.0): raise ValueError('you must set 0.0 <= --charset-ratio <= 1.0')
+        for x in (args.charset1, args.charset2):
+            if x is not None: re.compile('[%s]' % x)
     except Exception as ex:
         p.print_usage(file=sys.stderr)
         sys.exit()
 
+    args.dedup = args.dedup or args.near_dup
+
     return args
 
 
 def main():
+    global _args, _rules
     args = parse_args()
+    _args = args
+    _rules = make_rules(args)
 
     path_if = args.in1
     path_ie = args.in2
@@ -101,19 +389,41 @@ def main():
         open(path_oe, 'w') as fp_oe:
         stored = 0
         ignored = 0
-        for text_f, text_e in zip(fp_if, fp_ie):
-            text_f = normalize_spaces(text_f)
-            text_e = normalize_spaces(text_e)
-            text_f = replace_chars(text_f)
-            text_e = replace_chars(text_e)
-            if check_length(text_f, text_e, args):
-                fp_of.write(text_f + '\n')
-                fp_oe.write(text_e + '\n')
-                stored += 1
-            else:
-                ignored += 1
+        dedup = Dedup(args) if args.dedup else None
+        stats = Filter(_rules)
+        pairs = zip(fp_if, fp_ie)
+        if args.workers == 1:
+            results = map(clean_chunk, chunks(pairs, args.chunk))
+            pool = None
+        else:
+            # imap keeps the order of chunks
+            pool = multiprocessing.get_context('fork').Pool(args.workers)
+            results = pool.imap(clean_chunk, chunks(pairs, args.chunk))
+
+        try:
+            for result, rejects, seconds in results:
+                for name in rejects:
+                    stats.rejects[name] += rejects[name]
+                    stats.seconds[name] += seconds[name]
+                for pair in result:
+                    if pair is not None and (dedup is None or not dedup.check(pair[2])):
+                        fp_of.write(pair[0] + '\n')
+                        fp_oe.write(pair[1] + '\n')
+                        stored += 1
+                    else:
+                        ignored += 1
+        finally:
+            if pool is not None:
+                pool.terminate()
 
         print("%d stored, %d ignored." % (stored, ignored), file=sys.stderr)
+        for name, test in stats.rules:
+            print("  %-10s %d rejected, %.2f sec." % (name, stats.rejects[name], stats.seconds[name]), file=sys.stderr)
+        if dedup is not None:
+            print("%d exact duplicates, %d near duplicates removed." % \
+                (dedup.exact_removed, dedup.near_removed), file=sys.stderr)
+            if dedup.dropped():
+                print("WARNING: %d hashes were not stored for lack of --dedup-memory." % dedup.dropped(), file=sys.stderr)
     
 
 if __name__ == '__main__':
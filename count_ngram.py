@@ -1,32 +1,561 @@
 #!/usr/bin/python3
 
+import heapq
+import locale
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
 import sys
+import tempfile
+import zlib
+from argparse import ArgumentParser
+from array import array
 from collections import defaultdict
+from util import count_file, file_range
 
 
-def main():
-    if len(sys.argv) != 2:
-        print('usage: count_ngram.py N < input_toks', file=sys.stderr)
-        print('  - N: length of n-gram (1 <= N <= 7)', file=sys.stderr)
-        return
+# max number of runs merged at once
+MAX_FANOUT = 256
+
+
+def parse_args():
+    p = ArgumentParser(
+        description='n-gram counter',
+        usage='%(prog)s [options] N < input_toks\n' + \
+            '       %(prog)s [options] N --input input_toks --workers W')
+
+    p.add_argument('N', type=int,
+        help='length of n-gram (1 <= N <= 7)')
+    p.add_argument('--all-orders', dest='all_orders', action='store_true',
+        help='count all n-grams of length 1 to N in one pass. ' + \
+            'each line of output is tagged with its length unless --output is set')
+    p.add_argument('--output', default=None, metavar='PREFIX',
+        help='with --all-orders, write n-grams of length n into PREFIX.n')
+    p.add_argument('--memory', default=None, metavar='MB', type=int,
+        help='approximate upper bound of memory for counts. ' + \
+            'partial counts are spilled into temporary files, and the output is sorted')
+    p.add_argument('--input', default=None, metavar='FILE',
+        help='read the input from FILE instead of stdin')
+    p.add_argument('--workers', default=1, metavar='W', type=int,
+        help='number of processes counting byte ranges of --input (default: 1)')
+    p.add_argument('--engine', default='packed', choices=sorted(ENGINES),
+        help='packed: keys of integer word ids, tuple: keys of tuples of words (default: packed)')
+    p.add_argument('--approx', action='store_true',
+        help='approximately count only frequent n-grams with constant memory. ' + \
+            'output is the top K n-grams of each length in descending order of counts')
+    p.add_argument('--top', default=1000, metavar='K', type=int,
+        help='with --approx, number of n-grams to output (default: 1000)')
+    p.add_argument('--epsilon', default=1e-4, metavar='FLOAT', type=float,
+        help='with --approx, error of counts relative to the number of n-grams (default: 1e-4)')
+    p.add_argument('--delta', default=0.01, metavar='FLOAT', type=float,
+        help='with --approx, probability that a count exceeds the error (default: 0.01)')
+    p.add_argument('--sort', action='store_true',
+        help='sort n-grams of the output, so that count files can be merged by merge_counts.py')
+    p.add_argument('--binary', action='store_true',
+        help='write sorted counts in the binary format of util.count_file')
+
+    args = p.parse_args()
 
-    N = int(sys.argv[1])
-    if N < 1 or N > 7:
+    if args.N < 1 or args.N > 7:
         print('ERROR: N must be (1 <= N <= 7)', file=sys.stderr)
+        sys.exit(1)
+    if args.output is not None and not args.all_orders:
+        print('ERROR: --output requires --all-orders', file=sys.stderr)
+        sys.exit(1)
+    if args.memory is not None and args.memory < 1:
+        print('ERROR: --memory must be >= 1', file=sys.stderr)
+        sys.exit(1)
+    if args.workers < 1:
+        print('ERROR: --workers must be >= 1', file=sys.stderr)
+        sys.exit(1)
+    if args.workers > 1 and args.input is None:
+        print('ERROR: --workers requires --input', file=sys.stderr)
+        sys.exit(1)
+    if args.approx and (args.memory is not None or args.workers > 1):
+        print('ERROR: --approx cannot be used with --memory or --workers', file=sys.stderr)
+        sys.exit(1)
+    if args.binary and args.all_orders and args.output is None:
+        print('ERROR: --binary with --all-orders requires --output', file=sys.stderr)
+        sys.exit(1)
+    if args.top < 1 or not 0 < args.epsilon < 1 or not 0 < args.delta < 1:
+        print('ERROR: --top must be >= 1, and --epsilon and --delta must be in (0, 1)', file=sys.stderr)
+        sys.exit(1)
+
+    args.sort = args.sort or args.binary
+
+    return args
+
+
+class TupleCounts:
+    '''
+    n-gram counts keyed by tuples of words.
+    '''
+
+    # approximate bytes used by an n-gram: dict entry, tuple, strings and count,
+    # and its (text, count) item sorted by RunFiles.spill()
+    ENTRY_BYTES = 260
+    TOKEN_BYTES = 40
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.clear()
+
+    def clear(self):
+        self.freqs = {n: defaultdict(lambda: 0) for n in self.orders}
+
+    def __len__(self):
+        return sum(len(x) for x in self.freqs.values())
+
+    def nbytes(self):
+        return sum(len(x) * (self.ENTRY_BYTES + self.TOKEN_BYTES * n) for n, x in self.freqs.items())
+
+    def vocab_bytes(self):
+        return 0
+
+    def add(self, line):
+        ls = line.split()
+        for n, freq in self.freqs.items():
+            for i in range(len(ls) - n + 1):
+                freq[tuple(ls[i : i + n])] += 1
+
+    def text_items(self, n, sort=False):
+        items = ((' '.join(k), v) for k, v in self.freqs[n].items())
+        return sorted(items) if sort else items
+
+
+class PackedCounts:
+    '''
+    n-gram counts keyed by integers packing word ids of ID_BITS bits.
+    words are interned to ids as they are read, and decoded only when the counts are written.
+    the order of n-grams is the same as TupleCounts.
+    '''
+
+    # approximate bytes used by an n-gram: dict entry, packed key and count,
+    # and its (text, count) item sorted by RunFiles.spill()
+    ENTRY_BYTES = 240
+    TOKEN_BYTES = 16
+    # approximate bytes used by an interned word, which is kept after spilling counts
+    WORD_BYTES = 180
+    ID_BITS = 32
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.vocab = {}
+        self.words = []
+        self.clear()
+
+    def clear(self):
+        self.freqs = {n: defaultdict(lambda: 0) for n in self.orders}
+
+    def __len__(self):
+        return sum(len(x) for x in self.freqs.values())
+
+    def nbytes(self):
+        ngrams = sum(len(x) * (self.ENTRY_BYTES + self.TOKEN_BYTES * n) for n, x in self.freqs.items())
+        return ngrams + self.vocab_bytes()
+
+    def vocab_bytes(self):
+        return len(self.words) * self.WORD_BYTES
+
+    def add(self, line):
+        vocab = self.vocab
+        ids = []
+        for w in line.split():
+            x = vocab.get(w)
+            if x is None:
+                x = vocab[w] = len(self.words)
+                self.words.append(w)
+            ids.append(x)
+
+        B = PackedCounts.ID_BITS
+        for n, freq in self.freqs.items():
+            if n == 1:
+                for x in ids:
+                    freq[x] += 1
+                continue
+            # rolling key of the last n ids
+            mask = (1 << (B * n)) - 1
+            key = 0
+            for x in ids[: n - 1]:
+                key = (key << B) | x
+            for x in ids[n - 1 :]:
+                key = ((key << B) | x) & mask
+                freq[key] += 1
+
+    def text_items(self, n, sort=False):
+        words = self.words
+        B = PackedCounts.ID_BITS
+        id_mask = (1 << B) - 1
+        shifts = [B * i for i in reversed(range(n))]
+        items = (
+            (' '.join([words[(k >> s) & id_mask] for s in shifts]), v)
+            for k, v in self.freqs[n].items())
+        return sorted(items) if sort else items
+
+
+ENGINES = {'packed': PackedCounts, 'tuple': TupleCounts}
+
+
+class CountMinSketch:
+    '''
+    count-min sketch of width ceil(e / epsilon) and depth ceil(ln(1 / delta)).
+    with total count T, estimate(x) >= count(x), and estimate(x) <= count(x) + epsilon * T
+    with probability at least 1 - delta.
+    '''
+
+    def __init__(self, epsilon, delta):
+        self.width = math.ceil(math.e / epsilon)
+        self.depth = math.ceil(math.log(1 / delta))
+        self.rows = [array('Q', bytes(8 * self.width)) for i in range(self.depth)]
+
+    def __indices(self, key):
+        # double hashing: h1 + i * h2
+        h = hash(key) & 0xffffffffffffffff
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key):
+        for row, i in zip(self.rows, self.__indices(key)):
+            row[i] += 1
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self.__indices(key)))
+
+
+class SpaceSaving:
+    '''
+    Space-Saving summary of the top K items.
+    with total count T, every item with count > T / K is kept,
+    and the count of a kept item x is in [count(x), count(x) + error(x)] where error(x) <= T / K.
+    '''
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        # (count, item), which may be stale; fixed when popped
+        self.__heap = []
+
+    def add(self, key):
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+            return
+        if len(counts) < self.k:
+            counts[key] = 1
+            self.errors[key] = 0
+            heapq.heappush(self.__heap, (1, key))
+            return
+
+        # replace the item with the minimum count
+        heap = self.__heap
+        while True:
+            c, old = heap[0]
+            if counts[old] == c:
+                break
+            heapq.heapreplace(heap, (counts[old], old))
+        del counts[old]
+        del self.errors[old]
+        counts[key] = c + 1
+        self.errors[key] = c
+        heapq.heapreplace(heap, (c + 1, key))
+
+
+class ApproxCounts:
+    '''
+    approximate counts of frequent n-grams in constant memory.
+    each length has a CountMinSketch and a SpaceSaving summary of max(top, ceil(1 / epsilon)) items,
+    so that every n-gram with count > epsilon * T is kept in the summary,
+    and its count is overestimated by at most epsilon * T (with probability 1 - delta for the sketch).
+    the count of an n-gram is the minimum of both estimates, which never underestimate it.
+    '''
+
+    def __init__(self, orders, top, epsilon, delta):
+        self.orders = orders
+        self.top = top
+        self.sketches = {n: CountMinSketch(epsilon, delta) for n in orders}
+        self.summaries = {n: SpaceSaving(max(top, math.ceil(1 / epsilon))) for n in orders}
+
+    def add(self, line):
+        ls = line.split()
+        for n in self.orders:
+            sketch = self.sketches[n]
+            summary = self.summaries[n]
+            for i in range(len(ls) - n + 1):
+                key = tuple(ls[i : i + n])
+                sketch.add(key)
+                summary.add(key)
+
+    def text_items(self, n):
+        sketch = self.sketches[n]
+        counts = self.summaries[n].counts
+        items = []
+        for k, v in counts.items():
+            items.append((' '.join(k), min(v, sketch.estimate(k))))
+        items.sort(key=lambda x: (-x[1], x[0]))
+        return items[: self.top]
+
+
+def count(lines, counts, max_bytes=None, spill=None):
+    '''
+    count n-grams of all lengths of counts in one pass.
+    if max_bytes is set, spill(counts) is called whenever the approximate bytes of counts reach it,
+    and counting continues with cleared counts.
+    interned words are not cleared, and n-grams are given at least as many bytes as them.
+    returns counts.
+    '''
+    for l in lines:
+        counts.add(l)
+        if max_bytes is not None and counts.nbytes() >= max(max_bytes, 2 * counts.vocab_bytes()):
+            spill(counts)
+            counts.clear()
+
+    return counts
+
+
+def write(fp, items, tag=None):
+    prefix = '%d\t' % tag if tag is not None else ''
+    for k, v in items:
+        fp.write('%s%s\t%d\n' % (prefix, k, v))
+
+
+class RunFiles:
+    '''
+    sorted partial counts of each n-gram length stored in temporary files.
+    '''
+
+    def __init__(self, tmpdir):
+        self.__tmpdir = tmpdir
+        self.__runs = defaultdict(list)
+        self.__num_runs = 0
+
+    def __new_path(self):
+        self.__num_runs += 1
+        return os.path.join(self.__tmpdir, 'run.%06d' % self.__num_runs)
+
+    def spill(self, counts):
+        for n in counts.orders:
+            if not counts.freqs[n]:
+                continue
+            path = self.__new_path()
+            items = counts.text_items(n, sort=True)
+            # free counts of this length before sorting the next one
+            counts.freqs[n].clear()
+            with open(path, 'w') as fp:
+                write(fp, items)
+            del items
+            self.__runs[n].append(path)
+
+    def items(self, n):
+        '''
+        merge all runs of n-grams of length n.
+        runs are merged in multiple passes if there are more than MAX_FANOUT runs.
+        '''
+        runs = self.__runs[n]
+        while len(runs) > MAX_FANOUT:
+            path = self.__new_path()
+            with open(path, 'w') as fp:
+                self.__merge_into(fp, runs[:MAX_FANOUT])
+            for x in runs[:MAX_FANOUT]:
+                os.remove(x)
+            runs = runs[MAX_FANOUT:] + [path]
+        self.__runs[n] = runs
+
+        fps = [open(x) for x in runs]
+        try:
+            yield from count_file.merge(count_file.read_text(fp) for fp in fps)
+        finally:
+            for fp in fps:
+                fp.close()
+
+    def __merge_into(self, out_fp, paths):
+        fps = [open(x) for x in paths]
+        try:
+            write(out_fp, count_file.merge(count_file.read_text(fp) for fp in fps))
+        finally:
+            for fp in fps:
+                fp.close()
+
+
+def output(args, orders, items, is_sorted=False):
+    '''
+    write n-grams for each length given by items(n).
+    '''
+    def dump(fp, n, tag=None):
+        x = items(n)
+        if args.sort and not is_sorted:
+            x = sorted(x)
+        if args.binary:
+            count_file.write_binary(fp, x)
+        else:
+            write(fp, x, tag)
+
+    if not args.all_orders:
+        dump(sys.stdout.buffer if args.binary else sys.stdout, args.N)
+    elif args.output is None:
+        for n in orders:
+            dump(sys.stdout, n, tag=n)
+    else:
+        for n in orders:
+            with open('%s.%d' % (args.output, n), 'wb' if args.binary else 'w') as fp:
+                dump(fp, n)
+
+
+def output_files(args, orders, paths):
+    '''
+    concatenate files given by paths(n) which are already formatted for the output.
+    '''
+    def copy(out_fp, n):
+        for path in paths(n):
+            with open(path) as fp:
+                shutil.copyfileobj(fp, out_fp)
+
+    if args.output is None:
+        for n in orders:
+            copy(sys.stdout, n)
+    else:
+        for n in orders:
+            with open('%s.%d' % (args.output, n), 'w') as fp:
+                copy(fp, n)
+
+
+def read_range(path, begin, end):
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as fp:
+        fp.seek(begin)
+        pos = begin
+        while pos < end:
+            l = fp.readline()
+            if not l:
+                break
+            pos += len(l)
+            yield l.decode(encoding)
+
+
+def count_map(task):
+    '''
+    count n-grams in a byte range of the input.
+    if sort is not set, counts are partitioned by hash of n-gram into files map.i.r for each reducer r.
+    otherwise counts are spilled into sorted runs whenever max_bytes is reached,
+    and merged into files map.i.n.
+    '''
+    i, path, begin, end, engine, orders, reducers, max_bytes, sort, tmpdir = task
+    lines = read_range(path, begin, end)
+    counts = engine(orders)
+
+    if not sort:
+        count(lines, counts)
+        parts = [{n: {} for n in orders} for r in range(reducers)]
+        for n in orders:
+            for k, v in counts.text_items(n):
+                parts[zlib.crc32(k.encode('utf-8')) % reducers][n][k] = v
+        del counts
+        for r, part in enumerate(parts):
+            with open(os.path.join(tmpdir, 'map.%d.%d' % (i, r)), 'wb') as fp:
+                pickle.dump(part, fp, pickle.HIGHEST_PROTOCOL)
         return
 
-    freq = defaultdict(lambda: 0)
+    rundir = os.path.join(tmpdir, 'runs.%d' % i)
+    os.mkdir(rundir)
+    runs = RunFiles(rundir)
+    runs.spill(count(lines, counts, max_bytes, runs.spill))
+    for n in orders:
+        with open(os.path.join(tmpdir, 'map.%d.%d' % (i, n)), 'w') as fp:
+            write(fp, runs.items(n))
+    shutil.rmtree(rundir)
 
-    for l in sys.stdin:
-        ls = l.split()
-        for i in range(len(ls) - N + 1):
-            freq[tuple(ls[i : i + N])] += 1
 
-    for k, v in freq.items():
-        print('%s\t%d' % (' '.join(k), v))
+def count_reduce(task):
+    '''
+    sum up counts of the partition r from all mappers, and write them into files reduce.r.n.
+    '''
+    r, mappers, orders, tagged, tmpdir = task
+    freqs = {n: defaultdict(lambda: 0) for n in orders}
+    for i in range(mappers):
+        path = os.path.join(tmpdir, 'map.%d.%d' % (i, r))
+        with open(path, 'rb') as fp:
+            part = pickle.load(fp)
+        os.remove(path)
+        for n, freq in part.items():
+            total = freqs[n]
+            for k, v in freq.items():
+                total[k] += v
+    for n, freq in freqs.items():
+        with open(os.path.join(tmpdir, 'reduce.%d.%d' % (r, n)), 'w') as fp:
+            write(fp, freq.items(), tag=n if tagged else None)
 
 
-if __name__ == '__main__':
-    main()
+def count_parallel(args, orders):
+    '''
+    count n-grams with multiple processes.
+    input ranges are counted by mappers, and their partial counts are merged either by
+    hash-partitioned reducers, or by merging sorted runs if --memory or --sort is set.
+    '''
+    engine = ENGINES[args.engine]
+    ranges = [(b, e) for b, e in file_range.split_ranges(args.input, args.workers) if b < e]
+    tagged = args.all_orders and args.output is None
+    sort = args.sort or args.memory is not None
+    with tempfile.TemporaryDirectory(prefix='count_ngram.') as tmpdir, \
+            multiprocessing.Pool(args.workers) as pool:
+        if args.memory is None:
+            max_bytes = None
+        else:
+            max_bytes = args.memory * 1000000 // args.workers
+        tasks = [
+            (i, args.input, b, e, engine, orders, args.workers, max_bytes, sort, tmpdir)
+            for i, (b, e) in enumerate(ranges)]
+        pool.map(count_map, tasks, chunksize=1)
+
+        if not sort:
+            tasks = [(r, len(ranges), orders, tagged, tmpdir) for r in range(args.workers)]
+            pool.map(count_reduce, tasks, chunksize=1)
+            output_files(args, orders, lambda n: [
+                os.path.join(tmpdir, 'reduce.%d.%d' % (r, n)) for r in range(args.workers)])
+            return
+
+        def items(n):
+            fps = [open(os.path.join(tmpdir, 'map.%d.%d' % (i, n))) for i in range(len(ranges))]
+            try:
+                yield from count_file.merge(count_file.read_text(fp) for fp in fps)
+            finally:
+                for fp in fps:
+                    fp.close()
+
+        output(args, orders, items, is_sorted=True)
+
+
+def main():
+    args = parse_args()
 
+    orders = range(1, args.N + 1) if args.all_orders else [args.N]
 
+    if args.workers > 1:
+        count_parallel(args, orders)
+        return
+
+    engine = ENGINES[args.engine]
+    fp = open(args.input) if args.input is not None else sys.stdin
+
+    if args.approx:
+        counts = count(fp, ApproxCounts(orders, args.top, args.epsilon, args.delta))
+        output(args, orders, counts.text_items)
+        return
+
+    if args.memory is None:
+        counts = count(fp, engine(orders))
+        output(args, orders, lambda n: counts.text_items(n, sort=args.sort), is_sorted=args.sort)
+        return
+
+    with tempfile.TemporaryDirectory(prefix='count_ngram.') as tmpdir:
+        runs = RunFiles(tmpdir)
+        counts = count(fp, engine(orders), args.memory * 1000000, runs.spill)
+        runs.spill(counts)
+        del counts
+        output(args, orders, runs.items, is_sorted=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+serve ARPA formatted LM to many processes.
+simple usage:
+  lm_server.py your_lm.bin --binary --socket /tmp/lm.sock
+clients use util.arpa_server.Client(path='/tmp/lm.sock').
+'''
+
+import sys
+from argparse import ArgumentParser
+from util import arpa
+from util import arpa_server
+
+
+def parse_args():
+    DEFAULT_STORAGE = 'dict'
+
+    p = ArgumentParser(description='LM scoring server')
+
+    p.add_argument('lm', help='ARPA file, or binary file made by make_binary_lm.py')
+    p.add_argument('--binary', action='store_true',
+        help='load LM as a binary file')
+    p.add_argument('--storage', default=DEFAULT_STORAGE, metavar='STR',
+        help='storage of ARPA file: dict | array (default: %s)' % DEFAULT_STORAGE)
+    p.add_argument('--cache-size', dest='cache_size', default=0, metavar='INT', type=int,
+        help='max number of memoized queries (default: 0)')
+    p.add_argument('--socket', default=None, metavar='PATH',
+        help='path of Unix domain socket')
+    p.add_argument('--port', default=None, metavar='INT', type=int,
+        help='port of localhost TCP socket')
+    p.add_argument('--max-batch', dest='max_batch', default=arpa_server.Server.DEFAULT_MAX_BATCH, metavar='INT', type=int,
+        help='max number of requests coalesced into one batch (default: %d)' % arpa_server.Server.DEFAULT_MAX_BATCH)
+
+    args = p.parse_args()
+
+    # checking
+    try:
+        if (args.socket is None) == (args.port is None): raise ValueError('you must set either --socket or --port')
+        if args.max_batch < 1: raise ValueError('you must set --max-batch >= 1')
+    except Exception as ex:
+        p.print_usage(file=sys.stderr)
+        print('ERROR: %s' % ex, file=sys.stderr)
+        sys.exit()
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.binary:
+        lm = arpa.LM.open_binary(args.lm, cache_size=args.cache_size)
+    else:
+        lm = arpa.LM(args.lm, storage=args.storage, cache_size=args.cache_size)
+
+    server = arpa_server.Server(lm, max_batch=args.max_batch)
+    print('serving %s on %s.' % (args.lm, args.socket or 'localhost:%d' % args.port), file=sys.stderr)
+    try:
+        server.run(path=args.socket, port=args.port)
+    except KeyboardInterrupt:
+        pass
+    requests, batches = server.stats()
+    print('%d requests in %d batches.' % (requests, batches), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+convert ARPA formatted LM into the binary format of util.arpa.
+the binary file is loaded by util.arpa.LM.open_binary() using mmap.
+'''
+
+import sys
+from argparse import ArgumentParser
+from util import arpa
+
+
+def parse_args():
+    DEFAULT_ENCODING = 'utf-8'
+    DEFAULT_BACKOFF = -5.0
+    DEFAULT_UNK_BIAS = 0.0
+
+    p = ArgumentParser(description='ARPA to binary LM converter')
+
+    p.add_argument('input', help='input ARPA file')
+    p.add_argument('output', help='output binary file')
+    p.add_argument('--encoding', default=DEFAULT_ENCODING, metavar='STR',
+        help='encoding of the ARPA file (default: %s)' % DEFAULT_ENCODING)
+    p.add_argument('--default-backoff', dest='default_backoff', default=DEFAULT_BACKOFF, metavar='FLOAT', type=float,
+        help='default backoff coefficient (default: %f)' % DEFAULT_BACKOFF)
+    p.add_argument('--unknown-bias', dest='unknown_bias', default=DEFAULT_UNK_BIAS, metavar='FLOAT', type=float,
+        help='bias for log-probability of unknown word (default: %f)' % DEFAULT_UNK_BIAS)
+    p.add_argument('--quantize', default=0, metavar='INT', type=int, choices=[0, 8, 16],
+        help='bits of quantized probs and backoffs: 8 | 16, or 0 to store float32 (default: 0)')
+    p.add_argument('--workers', default=1, metavar='INT', type=int,
+        help='number of processes parsing the ARPA file (default: 1)')
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    lm = arpa.LM(
+        args.input,
+        encoding=args.encoding,
+        default_backoff=args.default_backoff,
+        unknown_bias=args.unknown_bias,
+        storage='array',
+        quantize=args.quantize,
+        workers=args.workers)
+    info = lm.load_info()
+    print('loaded %s: %d n-grams in %.1f sec (%.0f n-grams/sec, %.1f MB/sec).' % \
+        (args.input, info.ngrams, info.seconds, info.ngrams / info.seconds, info.bytes / info.seconds / 1e6),
+        file=sys.stderr)
+    print('%d bytes of n-grams.' % lm.nbytes(), file=sys.stderr)
+
+    lm.save_binary(args.output)
+    print('wrote %s.' % args.output, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
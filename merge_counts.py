@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+merge sorted n-gram count files made by count_ngram.py --sort or --binary.
+counts of the same n-gram are summed up, streaming a k-way merge of all inputs.
+simple usage:
+  count_ngram.py 3 --binary < day1_toks > day1.cnt
+  count_ngram.py 3 --binary < day2_toks > day2.cnt
+  merge_counts.py day1.cnt day2.cnt --binary --min-count 2 > total.cnt
+'''
+
+import sys
+from argparse import ArgumentParser
+from util import count_file
+
+
+def parse_args():
+    p = ArgumentParser(description='n-gram count merger')
+
+    p.add_argument('inputs', nargs='+', metavar='FILE',
+        help='sorted count files of text or binary format')
+    p.add_argument('--output', default=None, metavar='FILE',
+        help='output file (default: stdout)')
+    p.add_argument('--binary', action='store_true',
+        help='write the binary format')
+    p.add_argument('--min-count', dest='min_count', default=1, metavar='INT', type=int,
+        help='discard n-grams of which merged count < INT (default: 1)')
+
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    items = count_file.merge(
+        count_file.check_sorted(count_file.read(path), path) for path in args.inputs)
+    if args.min_count > 1:
+        items = ((k, v) for k, v in items if v >= args.min_count)
+
+    try:
+        if args.binary:
+            if args.output is None:
+                count_file.write_binary(sys.stdout.buffer, items)
+            else:
+                with open(args.output, 'wb') as fp:
+                    count_file.write_binary(fp, items)
+        else:
+            if args.output is None:
+                count_file.write_text(sys.stdout, items)
+            else:
+                with open(args.output, 'w') as fp:
+                    count_file.write_text(fp, items)
+    except ValueError as ex:
+        print('ERROR: %s' % ex, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+prune ARPA formatted LM by relative entropy down to a number of entries or a memory budget.
+simple usage:
+  prune_lm.py your_lm.arpa pruned.arpa --entries 1000000
+  prune_lm.py your_lm.arpa pruned.bin --memory 100M --binary --quantize 8
+'''
+
+import math
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from util import arpa
+
+
+def parse_size(text):
+    UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    text = text.upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def parse_args():
+    DEFAULT_BACKOFF = -5.0
+    DEFAULT_UNK_BIAS = 0.0
+
+    p = ArgumentParser(description='LM pruner')
+
+    p.add_argument('input', help='input ARPA file, or binary file made by make_binary_lm.py')
+    p.add_argument('output', help='output ARPA file (or binary file with --binary)')
+    p.add_argument('--entries', default=0, metavar='INT', type=int,
+        help='max number of n-grams to keep')
+    p.add_argument('--memory', default=None, metavar='SIZE', type=parse_size,
+        help='max bytes of n-grams in array storage (measured as in the binary file), e.g. 512M')
+    p.add_argument('--input-binary', dest='input_binary', action='store_true',
+        help='load input as a binary file')
+    p.add_argument('--default-backoff', dest='default_backoff', default=DEFAULT_BACKOFF, metavar='FLOAT', type=float,
+        help='default backoff coefficient of input ARPA file, written to n-grams without backoffs (default: %f)' % DEFAULT_BACKOFF)
+    p.add_argument('--unknown-bias', dest='unknown_bias', default=DEFAULT_UNK_BIAS, metavar='FLOAT', type=float,
+        help='bias for log-probability of unknown word of input ARPA file (default: %f)' % DEFAULT_UNK_BIAS)
+    p.add_argument('--binary', action='store_true',
+        help='write output as a binary file')
+    p.add_argument('--quantize', default=0, metavar='INT', type=int, choices=[0, 8, 16],
+        help='bits of quantized probs and backoffs of the binary output: 8 | 16 (default: 0)')
+
+    args = p.parse_args()
+
+    # checking
+    try:
+        if (args.entries > 0) == (args.memory is not None): raise ValueError('you must set either --entries or --memory')
+        if args.memory is not None and args.memory <= 0: raise ValueError('you must set --memory > 0')
+    except Exception as ex:
+        p.print_usage(file=sys.stderr)
+        print('ERROR: %s' % ex, file=sys.stderr)
+        sys.exit()
+
+    return args
+
+
+def entries_for_memory(lm, memory, quantize):
+    # first estimate of array storage: 8 bytes of keys and prob/backoff codes for orders > 1,
+    # float32 pairs for unigrams. placeholders, codebooks and padding are not counted.
+    counts = [0] * lm.maxn()
+    for words, prob, backoff in lm.ngrams():
+        counts[len(words)-1] += 1
+    memory -= 8 * counts[0]
+    return counts[0] + max(memory // (8 + 2 * (quantize // 8 or 4)), 0)
+
+
+def build_array_lm(lm, ngrams, quantize, unknown_bias):
+    # load pruned n-grams into array storage through a temporary ARPA file.
+    # '<unk>' of ngrams already includes the unknown bias.
+    fd, temp = tempfile.mkstemp(suffix='.arpa')
+    os.close(fd)
+    try:
+        arpa.write_arpa(temp, ngrams)
+        return arpa.LM(
+            temp,
+            default_backoff=lm.default_backoff(),
+            unknown_bias=0.0 if lm.has_unknown() else unknown_bias,
+            storage='array',
+            quantize=quantize)
+    finally:
+        os.remove(temp)
+
+
+def binary_nbytes(lm):
+    # bytes of n-grams in the binary file, where codebooks are padded to full size
+    fd, temp = tempfile.mkstemp(suffix='.bin')
+    os.close(fd)
+    try:
+        lm.save_binary(temp)
+        return arpa.LM.open_binary(temp).nbytes()
+    finally:
+        os.remove(temp)
+
+
+def prune_to_memory(lm, memory, quantize, unknown_bias):
+    # prune and measure the actual array storage, shrinking the target until it fits in the budget
+    max_entries = entries_for_memory(lm, memory, quantize)
+    prev = None
+    while True:
+        ngrams = arpa.prune(lm, max_entries)
+        pruned = build_array_lm(lm, ngrams, quantize, unknown_bias)
+        nbytes = binary_nbytes(pruned)
+        print('%d n-grams remain (target: %d), %d bytes.' % (len(ngrams), max_entries, nbytes), file=sys.stderr)
+        if nbytes <= memory:
+            return ngrams, pruned
+        if len(ngrams) > max_entries:
+            # only unigrams and prefixes remain
+            print('WARNING: n-grams do not fit in %d bytes.' % memory, file=sys.stderr)
+            return ngrams, pruned
+        # bytes per n-gram between the last two trials, as codebooks and unigrams cost fixed bytes
+        if prev is not None and prev[0] > len(ngrams) and prev[1] > nbytes:
+            slope = (prev[1] - nbytes) / (prev[0] - len(ngrams))
+        else:
+            slope = nbytes / len(ngrams)
+        prev = (len(ngrams), nbytes)
+        max_entries = min(len(ngrams) - 1, len(ngrams) - math.ceil((nbytes - memory) / slope))
+
+
+def main():
+    args = parse_args()
+
+    if args.input_binary:
+        lm = arpa.LM.open_binary(args.input)
+    else:
+        lm = arpa.LM(args.input, default_backoff=args.default_backoff, unknown_bias=args.unknown_bias)
+
+    quantize = args.quantize if args.binary else 0
+    if args.entries > 0:
+        ngrams = arpa.prune(lm, args.entries)
+        print('%d n-grams remain (target: %d).' % (len(ngrams), args.entries), file=sys.stderr)
+        pruned = None
+    else:
+        ngrams, pruned = prune_to_memory(lm, args.memory, quantize, args.unknown_bias)
+
+    if not args.binary:
+        arpa.write_arpa(args.output, ngrams)
+        return
+
+    if pruned is None:
+        pruned = build_array_lm(lm, ngrams, quantize, args.unknown_bias)
+    pruned.save_binary(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+score sentences with ARPA formatted LM.
+prints log-probability of each sentence to stdout, and corpus statistics to stderr.
+perplexity is reported both over all words and without OOVs (as SRILM's ngram -ppl does),
+since OOVs are scored by the probability of <unk> plus --unknown-bias, which is 0.0 by default.
+simple usage (8-parallel computation):
+  score_lm.py your_lm.arpa --workers 8 < input_toks > scores
+'''
+
+import multiprocessing
+import sys
+import time
+from argparse import ArgumentParser
+from itertools import islice
+from util import arpa
+
+
+# LM shared with worker processes.
+# it is loaded before the pool is created, so forked workers inherit it (or its mmap) without pickling.
+_lm = None
+_markers = False
+
+
+def parse_args():
+    DEFAULT_WORKERS = 1
+    DEFAULT_CHUNK = 1000
+    DEFAULT_STORAGE = 'dict'
+    DEFAULT_BACKOFF = -5.0
+    DEFAULT_UNK_BIAS = 0.0
+
+    p = ArgumentParser(description='LM scorer')
+
+    p.add_argument('lm', help='ARPA file, or binary file made by make_binary_lm.py')
+    p.add_argument('input', nargs='?', default='/dev/stdin', help='input text file (default: stdin)')
+    p.add_argument('--binary', action='store_true',
+        help='load LM as a binary file')
+    p.add_argument('--storage', default=DEFAULT_STORAGE, metavar='STR',
+        help='storage of ARPA file: dict | array (default: %s)' % DEFAULT_STORAGE)
+    p.add_argument('--quantize', default=0, metavar='INT', type=int, choices=[0, 8, 16],
+        help='bits of quantized probs and backoffs of ARPA file with array storage: 8 | 16 (default: 0)')
+    p.add_argument('--default-backoff', dest='default_backoff', default=DEFAULT_BACKOFF, metavar='FLOAT', type=float,
+        help='default backoff coefficient of ARPA file (default: %f)' % DEFAULT_BACKOFF)
+    p.add_argument('--unknown-bias', dest='unknown_bias', default=DEFAULT_UNK_BIAS, metavar='FLOAT', type=float,
+        help='bias for log-probability of unknown word of ARPA file (default: %f)' % DEFAULT_UNK_BIAS)
+    p.add_argument('--markers', action='store_true',
+        help='score sentences between <s> and </s>')
+    p.add_argument('--workers', default=DEFAULT_WORKERS, metavar='INT', type=int,
+        help='number of worker processes parsing LM and scoring sentences (default: %d)' % DEFAULT_WORKERS)
+    p.add_argument('--chunk', default=DEFAULT_CHUNK, metavar='INT', type=int,
+        help='number of sentences sent to a worker at once (default: %d)' % DEFAULT_CHUNK)
+
+    args = p.parse_intermixed_args()
+
+    # checking
+    try:
+        if args.workers < 1: raise ValueError('you must set --workers >= 1')
+        if args.chunk < 1: raise ValueError('you must set --chunk >= 1')
+    except Exception as ex:
+        p.print_usage(file=sys.stderr)
+        sys.exit()
+
+    return args
+
+
+def load_lm(args):
+    if args.binary:
+        return arpa.LM.open_binary(args.lm)
+    else:
+        return arpa.LM(
+            args.lm,
+            default_backoff=args.default_backoff,
+            unknown_bias=args.unknown_bias,
+            storage=args.storage,
+            quantize=args.quantize,
+            workers=args.workers)
+
+
+def score_chunk(chunk):
+    ret = []
+    for line in chunk:
+        words = line.split()
+        if _markers:
+            state = _lm.begin_sentence(['<s>'])
+            words.append('</s>')
+        else:
+            state = _lm.begin_sentence()
+        logprob = 0.0
+        oov = 0
+        oov_logprob = 0.0
+        for w in words:
+            prob, state = _lm.score(state, w)
+            logprob += prob
+            if not _lm.known(w):
+                oov += 1
+                oov_logprob += prob
+        ret.append((logprob, len(words), oov, oov_logprob))
+    return ret
+
+
+def chunks(fp, size):
+    while True:
+        chunk = list(islice(fp, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def main():
+    global _lm, _markers
+    args = parse_args()
+
+    _lm = load_lm(args)
+    info = _lm.load_info()
+    print('loaded %s: %d n-grams in %.1f sec.' % (args.lm, info.ngrams, info.seconds), file=sys.stderr)
+    _markers = args.markers
+
+    num_sents = 0
+    num_words = 0
+    num_oovs = 0
+    total = 0.0
+    total_oov = 0.0
+    begin = time.time()
+
+    with open(args.input) as fp:
+        if args.workers == 1:
+            results = map(score_chunk, chunks(fp, args.chunk))
+            pool = None
+        else:
+            pool = multiprocessing.get_context('fork').Pool(args.workers)
+            results = pool.imap(score_chunk, chunks(fp, args.chunk))
+
+        try:
+            for result in results:
+                for logprob, length, oov, oov_logprob in result:
+                    print('%f' % logprob)
+                    num_sents += 1
+                    num_words += length
+                    num_oovs += oov
+                    total += logprob
+                    total_oov += oov_logprob
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    elapsed = time.time() - begin
+    ppl = 10.0 ** (-total / num_words) if num_words else float('nan')
+    num_known = num_words - num_oovs
+    ppl_known = 10.0 ** (-(total - total_oov) / num_known) if num_known else float('nan')
+    print('%d sentences, %d words, %d OOVs' % (num_sents, num_words, num_oovs), file=sys.stderr)
+    print('logprob = %f, ppl = %f' % (total, ppl), file=sys.stderr)
+    print('without OOVs: logprob = %f, ppl = %f' % (total - total_oov, ppl_known), file=sys.stderr)
+    print('%.1f sec, %.1f words/sec' % (elapsed, num_words / elapsed if elapsed else 0.0), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,20 +7,45 @@ simple usage (100-parallel computation):
     --output out.txt
     --command 'your-command < @IN@ > @OUT@'
     --shard 100
+
+load balancing with many small shards (1000 shards, 32-parallel computation):
+  sharding.py ... --shard 1000 --jobs 32
+
+retrying failed shards, and keeping shards to resume the job:
+  sharding.py ... --workdir work --retry 2
+  sharding.py ... --workdir work --resume
+
+contiguous shards of the input, fed through stdin if the command has no "@IN@",
+or through a named pipe given as "@IN@" (the input is not copied into shards):
+  sharding.py ... --command 'your-command > @OUT@' --contiguous
+
+streaming lines through 100 processes of a filter command without temporary files:
+  sharding.py ... --command 'your-command' --shard 100 --stream
+
+writing wall/CPU time, peak RSS and input size of each shard:
+  sharding.py ... --report report.json
 '''
 
+import collections
 import datetime
+import errno
+import itertools
+import json
 import os
+import queue
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 from argparse import ArgumentParser
+from util import file_range
 
 def parse_args():
   p = ArgumentParser(
     description='Simple sharding script',
-    usage='%(prog)s --input TXTFILE --output TXTFILE --command STR --shard N',
+    usage='%(prog)s --input TXTFILE --output TXTFILE --command STR --shard N [--jobs J]',
   )
 
   p.add_argument(
@@ -34,102 +59,524 @@ def parse_args():
   p.add_argument(
     '--command',
     type=str, metavar='STR', nargs='?', required=True,
-    help='command to be run, in which "@IN@" and "@OUT@" metavars should be included')
+    help='command to be run, in which "@IN@" and "@OUT@" metavars should be included ' + \
+      '("@IN@" may be omitted with --contiguous, and both are omitted with --stream)')
   p.add_argument(
     '--shard',
     type=int, metavar='INT', nargs='?', required=True,
-    help='number of shards')
+    help='number of shards (number of processes with --stream)')
+  p.add_argument(
+    '--jobs',
+    type=int, metavar='INT', nargs='?', default=None,
+    help='max number of commands running at once (default: same as --shard)')
+  p.add_argument(
+    '--retry',
+    type=int, metavar='INT', nargs='?', default=0,
+    help='max number of retries of each failed shard (default: 0)')
+  p.add_argument(
+    '--workdir',
+    type=str, metavar='STR', nargs='?', default=None,
+    help='directory to keep shards and completion markers, which are removed after merging')
+  p.add_argument(
+    '--resume',
+    action='store_true',
+    help='run only shards not completed in --workdir')
+  p.add_argument(
+    '--contiguous',
+    action='store_true',
+    help='split the input into contiguous byte ranges instead of round-robin lines, ' + \
+      'and concatenate outputs. "@IN@" is a named pipe, which the command must read once from the beginning')
+  p.add_argument(
+    '--stream',
+    action='store_true',
+    help='feed blocks of lines into stdin of --shard processes, and collect their stdout in the order of input. ' + \
+      'the command must write one line for each input line')
+  p.add_argument(
+    '--block-lines',
+    type=int, metavar='INT', nargs='?', default=1000,
+    help='number of lines of a block sent to a process with --stream (default: 1000)')
+  p.add_argument(
+    '--buffer-blocks',
+    type=int, metavar='INT', nargs='?', default=16,
+    help='max number of output blocks buffered for each process with --stream (default: 16)')
+  p.add_argument(
+    '--report',
+    type=str, metavar='STR', nargs='?', default=None,
+    help='JSON file to write metrics of each shard')
 
   args = p.parse_args()
   assert args.shard > 0
+  if args.jobs is None:
+    args.jobs = args.shard
+  assert args.jobs > 0
+  assert args.retry >= 0
+  assert args.workdir is not None or not args.resume, '--resume requires --workdir'
+  assert args.block_lines > 0
+  assert args.buffer_blocks >= 2
+  assert not (args.stream and (args.workdir or args.retry or args.contiguous)), \
+    '--stream cannot be used with --workdir, --retry or --contiguous'
   return args
 
-def poll_processes(process_list):
-  running = 0
-  succeeded = 0
-  failed = 0
-  for process in process_list:
-    code = process.poll()
-    if code is None:
-      running += 1
-    elif code == 0:
-      succeeded += 1
-    else:
-      failed += 1
-  return running, succeeded, failed
+def shard_path(workdir, kind, n):
+  return os.path.join(workdir, '%s.%04d' % (kind, n))
 
-def main(args):
-  # make file discriptors and file names
-  prefix = 'shard.%d.' % time.time()
-  in_filedesc_list, in_filename_list = zip(*(tempfile.mkstemp(prefix=prefix + '%04d.' % n) for n in range(args.shard)))
-  out_filename_list = [x + '.out' for x in in_filename_list]
+def header_text(args):
+  mode = 'contiguous' if args.contiguous else 'roundrobin'
+  return '%s\t%d\t%d\t%s\n' % (os.path.abspath(args.input), os.path.getsize(args.input), args.shard, mode)
+
+def check_workdir(args):
+  # returns True if input shards are already made in the workdir for the same input and sharding
+  header = os.path.join(args.workdir, 'shards')
+  expected = header_text(args)
+  if os.path.exists(header):
+    with open(header) as fp:
+      if fp.read() != expected:
+        raise RuntimeError('%s was made for another input or sharding' % args.workdir)
+    return True
+  return False
+
+def open_fifo(path, stop):
+  # open a named pipe for writing when the command opens it for reading.
+  # it is polled without blocking, so that the feeder ends if stop is set before that.
+  # returns the file object, or None if stopped.
+  while not stop.is_set():
+    try:
+      fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+    except OSError as ex:
+      # ENXIO: no reader yet
+      if ex.errno != errno.ENXIO:
+        raise
+      stop.wait(0.01)
+      continue
+    os.set_blocking(fd, True)
+    return open(fd, 'wb')
+  return None
 
+def feed_range(path, begin, end, pipe, metrics, stop=None):
+  # write a byte range of the file into stdin of a command, or into a named pipe given by its path.
+  # lines and bytes are counted into metrics while writing.
+  metrics['input_lines'] = 0
+  metrics['input_bytes'] = 0
+  if isinstance(pipe, str):
+    pipe = open_fifo(pipe, stop)
+    if pipe is None:
+      return
   try:
-    print('making input shards ...')
-    in_shard_fp_list = [os.fdopen(x, 'w') for x in in_filedesc_list]
+    with open(path, 'rb') as fp:
+      fp.seek(begin)
+      remaining = end - begin
+      while remaining > 0:
+        data = fp.read(min(remaining, 1 << 20))
+        if not data:
+          break
+        pipe.write(data)
+        metrics['input_lines'] += data.count(b'\n')
+        metrics['input_bytes'] += len(data)
+        remaining -= len(data)
+      # the last line of the file may have no newline
+      if remaining == 0 and begin < end and not data.endswith(b'\n'):
+        metrics['input_lines'] += 1
+  except BrokenPipeError:
+    pass
+  finally:
+    try:
+      pipe.close()
+    except BrokenPipeError:
+      pass
+
+
+def reap(process):
+  # returns rusage of the finished process, setting its returncode, or None if it is running
+  pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+  if pid == 0:
+    return None
+  process.returncode = os.waitstatus_to_exitcode(status)
+  return rusage
+
+def process_metrics(rusage, wall_time):
+  return {
+    'wall_time': round(wall_time, 3),
+    'user_time': round(rusage.ru_utime, 3),
+    'sys_time': round(rusage.ru_stime, 3),
+    'max_rss_kb': rusage.ru_maxrss,
+  }
+
+def format_rate(lines, done_bytes, total_bytes, elapsed):
+  # ETA is estimated from input bytes, as numbers of lines are not known before feeding them
+  seconds = elapsed.total_seconds()
+  rate = lines / seconds if seconds > 0 else 0.0
+  if done_bytes > 0 and seconds > 0:
+    eta = datetime.timedelta(seconds=int((total_bytes - done_bytes) * seconds / done_bytes))
+  else:
+    eta = '-'
+  return '%.0f lines/sec, ETA %s' % (rate, eta)
+
+def write_report(args, metrics, elapsed):
+  report = {
+    'command': args.command,
+    'input': args.input,
+    'elapsed': round(elapsed.total_seconds(), 3),
+    'shards': metrics,
+  }
+  with open(args.report, 'w') as fp:
+    json.dump(report, fp, indent=2)
+    fp.write('\n')
+
+def write_counts(workdir, counts):
+  with open(os.path.join(workdir, 'counts'), 'w') as fp:
+    for lines, size in counts:
+      fp.write('%d\t%d\n' % (lines, size))
+
+def read_counts(workdir):
+  # returns (lines, bytes) of each input shard, or None for contiguous shards
+  path = os.path.join(workdir, 'counts')
+  if not os.path.exists(path):
+    return None
+  with open(path) as fp:
+    return [tuple(int(x) for x in l.split('\t')) for l in fp]
+
+def make_input_shards(args, workdir, ranges):
+  # returns (lines, bytes) of each input shard, or None for contiguous shards,
+  # which are fed from the input while running commands.
+  counts = None
+  if ranges is None:
+    in_shard_fp_list = [open(shard_path(workdir, 'in', n), 'w') for n in range(args.shard)]
+    total = 0
     with open(args.input) as in_fp:
-      for n, line in enumerate(in_fp):
-        in_shard_fp_list[n % args.shard].write(line)
+      for total, line in enumerate(in_fp, 1):
+        in_shard_fp_list[(total - 1) % args.shard].write(line)
     for fp in in_shard_fp_list:
       fp.close()
+    counts = [
+      ((total - n + args.shard - 1) // args.shard, os.path.getsize(shard_path(workdir, 'in', n)))
+      for n in range(args.shard)]
+    write_counts(workdir, counts)
+  # written at last, so that incomplete shards are made again by --resume
+  with open(os.path.join(workdir, 'shards'), 'w') as fp:
+    fp.write(header_text(args))
+  return counts
 
-    process_list = []
-    begin_time = datetime.datetime.now()
+def run_shards(args, workdir, ranges, counts, metrics):
+  # run commands of shards without completion markers, keeping at most args.jobs processes running.
+  # byte ranges of the input are fed into stdin, or into named pipes given as "@IN@".
+  # counts are (lines, bytes) of input shards, or None if byte ranges are fed.
+  # metrics of each shard are appended to the list metrics.
+  # returns number of completed shards.
+  stdin_ranges = ranges is not None and '@IN@' not in args.command
+  fifo_ranges = ranges is not None and '@IN@' in args.command
+  pending = collections.deque(n for n in range(args.shard) if not os.path.exists(shard_path(workdir, 'done', n)))
+  skipped = args.shard - len(pending)
+  attempts = [0] * args.shard
+  start_times = [None] * args.shard
+  feeders = {}
+  running = {}
+  succeeded = 0
+  failed = 0
+  retried = 0
 
-    try:
-      # run command
-      for in_filename, out_filename in zip(in_filename_list, out_filename_list):
+  for n in range(args.shard):
+    if counts is not None:
+      lines, size = counts[n]
+    else:
+      # lines are counted by the feeder
+      lines, size = None, ranges[n][1] - ranges[n][0]
+    metrics.append({'shard': n, 'input_lines': lines, 'input_bytes': size, 'attempts': 0, 'skipped': n not in pending})
+  total_bytes = sum(x['input_bytes'] for x in metrics if not x['skipped'])
+  done_lines = 0
+  done_bytes = 0
+
+  if skipped:
+    print('%d shards are already completed.' % skipped)
+
+  begin_time = datetime.datetime.now()
+  try:
+    while pending or running:
+      for n, process in list(running.items()):
+        rusage = reap(process)
+        if rusage is None:
+          continue
+        del running[n]
+        if n in feeders:
+          # the feeder of a named pipe stops waiting for a reader, if the command never opened it
+          feeder, stop = feeders.pop(n)
+          if stop is not None:
+            stop.set()
+          feeder.join()
+          if fifo_ranges:
+            os.remove(shard_path(workdir, 'fifo', n))
+        code = process.returncode
+        metrics[n].update(process_metrics(rusage, time.time() - start_times[n]))
+        metrics[n]['exit_code'] = code
+        metrics[n]['attempts'] = attempts[n]
+        if code == 0:
+          open(shard_path(workdir, 'done', n), 'w').close()
+          succeeded += 1
+          done_lines += metrics[n]['input_lines']
+          done_bytes += metrics[n]['input_bytes']
+        elif attempts[n] <= args.retry:
+          pending.append(n)
+          retried += 1
+        else:
+          failed += 1
+
+      while len(running) < args.jobs and pending:
+        n = pending.popleft()
+        in_filename = shard_path(workdir, 'fifo' if fifo_ranges else 'in', n)
+        out_filename = shard_path(workdir, 'out', n)
+        if os.path.exists(out_filename):
+          os.remove(out_filename)
         command = args.command.replace('@IN@', in_filename).replace('@OUT@', out_filename)
-        process = subprocess.Popen(command, shell=True)
-        process_list.append(process)
-      
-      # wait
+        start_times[n] = time.time()
+        if stdin_ranges:
+          process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+          feeder = threading.Thread(target=feed_range, args=(args.input,) + ranges[n] + (process.stdin, metrics[n]), daemon=True)
+          feeder.start()
+          feeders[n] = (feeder, None)
+        elif fifo_ranges:
+          if os.path.exists(in_filename):
+            os.remove(in_filename)
+          os.mkfifo(in_filename)
+          process = subprocess.Popen(command, shell=True)
+          stop = threading.Event()
+          feeder = threading.Thread(target=feed_range, args=(args.input,) + ranges[n] + (in_filename, metrics[n], stop), daemon=True)
+          feeder.start()
+          feeders[n] = (feeder, stop)
+        else:
+          process = subprocess.Popen(command, shell=True)
+        running[n] = process
+        attempts[n] += 1
+
+      elapsed = datetime.datetime.now() - begin_time
+      print('%s: %d pending, %d running, %d succeeded, %d failed, %d retried, %s' % \
+        (elapsed, len(pending), len(running), succeeded, failed, retried,
+        format_rate(done_lines, done_bytes, total_bytes, elapsed)), end='\r')
+      if not pending and not running:
+        break
+      # check more often while shards are waiting for free slots
+      time.sleep(0.05 if pending else 0.2)
+    print()
+
+  except BaseException as ex:
+    print()
+    print('ERROR: %s: %s' % (type(ex).__name__, ex))
+    # terminate all processes
+    for process in running.values():
+      try:
+        process.terminate()
+      except:
+        pass
+    print('all processes are terminated.')
+
+  return skipped + succeeded
+
+def merge_output_shards(args, workdir):
+  if args.contiguous:
+    with open(args.output, 'wb') as out_fp:
+      for n in range(args.shard):
+        with open(shard_path(workdir, 'out', n), 'rb') as fp:
+          shutil.copyfileobj(fp, out_fp, 1 << 20)
+    return
+
+  out_shard_fp_list = [open(shard_path(workdir, 'out', n)) for n in range(args.shard)]
+  with open(args.output, 'w') as out_fp:
+    try:
+      n = 0
       while True:
-        running, succeeded, failed = poll_processes(process_list)
-        elapsed = datetime.datetime.now() - begin_time
-        print('%s: %d running, %d succeeded, %d failed' % \
-          (elapsed, running, succeeded, failed), end='\r')
-        if succeeded + failed == args.shard:
-          break
-        time.sleep(0.2)
-      print()
+        line = next(out_shard_fp_list[n])
+        out_fp.write(line)
+        n = (n + 1) % args.shard
+    except StopIteration:
+      pass
+  for fp in out_shard_fp_list:
+    fp.close()
+
+def remove_shards(args, workdir):
+  for kind in ('in', 'fifo', 'out', 'done'):
+    for n in range(args.shard):
+      fn = shard_path(workdir, kind, n)
+      if os.path.exists(fn):
+        os.remove(fn)
+  for name in ('counts', 'shards'):
+    fn = os.path.join(workdir, name)
+    if os.path.exists(fn):
+      os.remove(fn)
+  try:
+    os.rmdir(workdir)
+  except OSError:
+    pass
 
+def run_stream(args):
+  # blocks of lines are sent to processes round-robin.
+  # a reader thread of each process cuts its stdout into blocks of the same numbers of lines,
+  # and the main thread writes them in the order of input.
+  process_list = [
+    subprocess.Popen(args.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    for n in range(args.shard)]
+  # numbers of lines and bytes of blocks sent to each process, and None at the end
+  size_queues = [queue.Queue() for n in range(args.shard)]
+  # output blocks of each process with their input bytes, and None at the end (or an exception)
+  out_queues = [queue.Queue(args.buffer_blocks) for n in range(args.shard)]
+  errors = []
+  metrics = [{'shard': k, 'input_lines': 0, 'input_bytes': 0} for k in range(args.shard)]
+  total_bytes = os.path.getsize(args.input)
+
+  def write_input():
+    try:
+      with open(args.input, 'rb') as in_fp:
+        for n in itertools.count():
+          lines = list(itertools.islice(in_fp, args.block_lines))
+          if not lines:
+            break
+          k = n % args.shard
+          block = b''.join(lines)
+          size_queues[k].put((len(lines), len(block)))
+          process_list[k].stdin.write(block)
+          process_list[k].stdin.flush()
+          metrics[k]['input_lines'] += len(lines)
+          metrics[k]['input_bytes'] += len(block)
     except BaseException as ex:
-      print()
-      print('ERROR: %s: %s' % (type(ex).__name__, ex))
-      # terminate all processes
-      for process in process_list:
+      errors.append(ex)
+    finally:
+      for k in range(args.shard):
+        size_queues[k].put(None)
         try:
-          process.terminate()
-        except:
+          process_list[k].stdin.close()
+        except BrokenPipeError:
           pass
-      print('all processes are terminated.')
-    
-    running, succeeded, failed = poll_processes(process_list)
-    if succeeded == args.shard:
+
+  def read_output(k):
+    fp = process_list[k].stdout
+    try:
+      while True:
+        item = size_queues[k].get()
+        if item is None:
+          if fp.read(1):
+            raise RuntimeError('process %d wrote more lines than input' % k)
+          out_queues[k].put(None)
+          return
+        size, in_bytes = item
+        lines = [fp.readline() for i in range(size)]
+        if not lines[-1]:
+          raise RuntimeError('process %d wrote fewer lines than input' % k)
+        out_queues[k].put((b''.join(lines), in_bytes))
+    except BaseException as ex:
+      out_queues[k].put(ex)
+
+  threads = [threading.Thread(target=write_input, daemon=True)]
+  threads += [threading.Thread(target=read_output, args=(k,), daemon=True) for k in range(args.shard)]
+  for thread in threads:
+    thread.start()
+
+  begin_time = datetime.datetime.now()
+  last_time = begin_time
+  lines = 0
+  done_bytes = 0
+  try:
+    with open(args.output, 'wb') as out_fp:
+      for n in itertools.count():
+        item = out_queues[n % args.shard].get()
+        if item is None:
+          break
+        if isinstance(item, BaseException):
+          raise item
+        block, in_bytes = item
+        out_fp.write(block)
+        lines += block.count(b'\n')
+        done_bytes += in_bytes
+        now = datetime.datetime.now()
+        if now - last_time > datetime.timedelta(seconds=0.2):
+          elapsed = now - begin_time
+          print('%s: %d blocks, %d lines, %s' % \
+            (elapsed, n + 1, lines, format_rate(lines, done_bytes, total_bytes, elapsed)), end='\r')
+          last_time = now
+    # the other readers have no more blocks, and end with None or an exception
+    # (e.g. their processes wrote more lines than input)
+    for k in range(n + 1, n + args.shard):
+      block = out_queues[k % args.shard].get()
+      if isinstance(block, BaseException):
+        raise block
+    for thread in threads:
+      thread.join()
+    elapsed = datetime.datetime.now() - begin_time
+    print('%s: %d blocks, %d lines, %.0f lines/sec' % \
+      (elapsed, n, lines, lines / max(elapsed.total_seconds(), 1e-6)))
+    if errors:
+      raise errors[0]
+    for k, process in enumerate(process_list):
+      pid, status, rusage = os.wait4(process.pid, 0)
+      process.returncode = os.waitstatus_to_exitcode(status)
+      metrics[k].update(process_metrics(rusage, elapsed.total_seconds()))
+      metrics[k]['exit_code'] = process.returncode
+    failed = sum(1 for process in process_list if process.returncode != 0)
+    if failed:
+      raise RuntimeError('%d processes failed' % failed)
+    return True
+
+  except BaseException as ex:
+    print()
+    print('ERROR: %s: %s' % (type(ex).__name__, ex))
+    for process in process_list:
+      try:
+        process.terminate()
+      except:
+        pass
+    print('all processes are terminated.')
+    if os.path.exists(args.output):
+      os.remove(args.output)
+    return False
+
+  finally:
+    if args.report is not None:
+      write_report(args, metrics, datetime.datetime.now() - begin_time)
+
+def main(args):
+  if args.stream:
+    run_stream(args)
+    return
+
+  if args.workdir is not None:
+    workdir = args.workdir
+    os.makedirs(workdir, exist_ok=True)
+  else:
+    workdir = tempfile.mkdtemp(prefix='shard.%d.' % time.time())
+  completed = 0
+  counts = None
+  metrics = []
+  begin_time = datetime.datetime.now()
+
+  try:
+    ranges = file_range.split_ranges(args.input, args.shard) if args.contiguous else None
+    if args.resume and check_workdir(args):
+      print('using input shards in %s ...' % workdir)
+      counts = read_counts(workdir)
+    else:
+      if args.workdir is not None:
+        # previous results are invalid without --resume
+        remove_shards(args, workdir)
+        os.makedirs(workdir, exist_ok=True)
+      print('making input shards ...')
+      counts = make_input_shards(args, workdir, ranges)
+
+    completed = run_shards(args, workdir, ranges, counts, metrics)
+
+    if completed == args.shard:
       print('merging results ...')
-      out_shard_fp_list = [open(x) for x in out_filename_list]
-      with open(args.output, 'w') as out_fp:
-        try:
-          n = 0
-          while True:
-            line = next(out_shard_fp_list[n])
-            out_fp.write(line)
-            n = (n + 1) % args.shard
-        except StopIteration:
-          pass
-      for fp in out_shard_fp_list:
-        fp.close()
+      merge_output_shards(args, workdir)
   except BaseException as ex:
     print('ERROR: %s: %s' % (type(ex).__name__, ex))
 
+  if args.report is not None:
+    write_report(args, metrics, datetime.datetime.now() - begin_time)
+
+  if args.workdir is not None and completed < args.shard:
+    print('%d shards are not completed. rerun with --resume to run only them.' % (args.shard - completed))
+    return
+
   print('removing input/output shards ...')
-  for fn in in_filename_list:
-    if os.path.exists(fn):
-      os.remove(fn)
-  for fn in out_filename_list:
-    if os.path.exists(fn):
-      os.remove(fn)
+  if args.workdir is not None:
+    remove_shards(args, workdir)
+  else:
+    shutil.rmtree(workdir, ignore_errors=True)
 
 if __name__ == '__main__':
   args = parse_args()
@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+'''
+restore chars escaped by clean_parallel.py, e.g. -LRB- to (.
+note that tokens which were already in the form of -LRB- before cleaning are also restored.
+'''
+
+import sys
+from clean_parallel import restore_chars
+
+if len(sys.argv) < 2:
+  for l in sys.stdin:
+    print(restore_chars(l.rstrip('\n')))
+else:
+  for f in sys.argv[1:]:
+    for l in open(f):
+      print(restore_chars(l.rstrip('\n')))
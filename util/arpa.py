@@ -11,11 +11,556 @@ USAGE:
 	lm = arpa.LM('your_lm.arpa', default_backoff=-42, unknown_bias=-42)
 	cp = lm.condprob(ngram)
 	jp = lm.jointprob(sentence)
+	
+	# convert words to ids once and score them repeatedly
+	ids = lm.ids(sentence)
+	jp = lm.jointprob_ids(ids)
+	
+	# incremental scoring
+	state = lm.begin_sentence()
+	for word in sentence:
+		prob, state = lm.score(state, word)
+	
+	# compact storage for large models
+	lm = arpa.LM('your_lm.arpa', storage='array')
+	
+	# binary model loaded by mmap (pages are shared among processes)
+	lm.save_binary('your_lm.bin')
+	lm = arpa.LM.open_binary('your_lm.bin')
+	
+	# memoize repeated queries
+	lm = arpa.LM('your_lm.arpa', cache_size=100000)
+	hits, misses, maxsize, currsize = lm.cache_info()
 '''
 
 
-from collections import defaultdict
+import math
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+from functools import lru_cache
+from itertools import islice, repeat
 from numbers import Real
+from operator import eq, lshift, ne, or_
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+LoadInfo = namedtuple('LoadInfo', ['ngrams', 'bytes', 'seconds'])
+
+
+# size of blocks of n-gram sections parsed at once
+_PARSE_BLOCK_SIZE = 1 << 22
+
+# file and vocabulary shared with forked parser processes
+_parse_buf = None
+_parse_vocab = None
+
+
+def _parse_block(task):
+	'''
+	parse a block of an n-gram section in bulk.
+	all lines of the block must have the same fields, and all words must be in the vocabulary.
+	@param task (n, begin, end): order and byte range of the block in _parse_buf
+	@return (task, columns): columns is (word id columns, probs, backoffs or None),
+		or None if the block has to be parsed line by line.
+	'''
+	
+	n, begin, end = task
+	data = _parse_buf[begin:end]
+	tokens = data.split()
+	tabs = data.count(b'\t')
+	if tabs % 2 == 0 and len(tokens) == tabs // 2 * (n+2):
+		# with backoffs
+		width = n + 2
+		rows = tabs // 2
+	elif len(tokens) == tabs * (n+1):
+		# without backoffs
+		width = n + 1
+		rows = tabs
+	else:
+		return task, None
+	if data.count(b' ') != rows * (n-1):
+		return task, None
+	
+	try:
+		cols = [array('l', map(_parse_vocab.__getitem__, tokens[i+1::width])) for i in range(n)]
+		probs = array('d', map(float, tokens[0::width]))
+		backoffs = array('d', map(float, tokens[n+1::width])) if width == n + 2 else None
+	except (KeyError, ValueError):
+		return task, None
+	return task, (cols, probs, backoffs)
+
+
+def _find_sections(buf):
+	'''
+	find n-gram sections following the \\data\\ header.
+	@return list of (n, begin, end) byte ranges of section bodies, or None if there is no header.
+	'''
+	
+	if not buf[:1024].lstrip().startswith(b'\\data\\'):
+		return None
+	ret = []
+	pos = buf.find(b'\n\\', buf.find(b'\\data\\') + 1)
+	while pos >= 0:
+		begin = buf.find(b'\n', pos + 1)
+		name = buf[pos+1:begin if begin >= 0 else len(buf)].strip()
+		end = buf.find(b'\n\\', pos + 1)
+		if name.endswith(b'-grams:') and begin >= 0:
+			ret.append((int(name[1:-len(b'-grams:')]), begin + 1, end if end >= 0 else len(buf)))
+		pos = end
+	return ret
+
+
+_QUANTIZE_TYPECODES = {8: 'B', 16: 'H'}
+
+
+def _quantize(values, bits, typecode):
+	'''
+	bin values into a codebook of equal-population bins.
+	code 0 is reserved for NaN, and values are kept as-is if few enough.
+	@return (codebook, codes)
+	'''
+	
+	size = (1 << bits) - 1
+	finite = sorted(x for x in values if x == x)
+	centers = sorted(set(finite))
+	if len(centers) > size:
+		centers = []
+		for i in range(size):
+			bin = finite[len(finite) * i // size : len(finite) * (i+1) // size]
+			if bin:
+				centers.append(sum(bin) / len(bin))
+		centers = sorted(set(centers))
+	
+	# boundaries between neighboring centers
+	bounds = [(a + b) / 2 for a, b in zip(centers, centers[1:])]
+	codebook = array('f', [float('nan')] + centers)
+	codes = array(typecode, (bisect_left(bounds, x) + 1 if x == x else 0 for x in values))
+	return codebook, codes
+
+
+class _DictTable:
+	'''
+	n-gram table holding every n-gram in one dict:
+	(word ids) -> (prob, backoff).
+	'''
+
+	def __init__(self, default_backoff):
+		self.__table = {}
+		self.__ids = [] # shared int objects of word ids
+
+
+	def add(self, ngram, prob, backoff):
+		self.__table[ngram] = (prob, backoff)
+
+
+	def add_columns(self, cols, probs, backoffs):
+		'''
+		add n-grams of the same order given as columns.
+		@param cols list of word id columns
+		@param probs column of probs
+		@param backoffs column of backoffs
+		'''
+		
+		# word ids of parsed columns are new int objects for every row,
+		# so they are replaced with shared ones to keep keys as small as those of add().
+		top = max(max(col) for col in cols) + 1 if probs else 0
+		if len(self.__ids) < top:
+			self.__ids.extend(range(len(self.__ids), top))
+		cols = [map(self.__ids.__getitem__, col) for col in cols]
+		self.__table.update(zip(zip(*cols), zip(probs, backoffs)))
+
+
+	def finalize(self, vocab_size):
+		pass
+
+
+	def items(self):
+		return self.__table.items()
+
+
+	def root(self):
+		'''
+		retrieve handle of the empty n-gram.
+		'''
+		
+		return ()
+
+
+	def child(self, n, handle, wid):
+		'''
+		retrieve handle of the n-gram made by appending a word to the (n-1)-gram of given handle.
+		'''
+		
+		return handle + (wid,)
+
+
+	def entry(self, n, handle):
+		'''
+		retrieve stored values of the n-gram of given handle.
+		@return (prob, backoff) or None if the n-gram is not stored.
+		'''
+		
+		return self.__table.get(handle)
+
+
+	def get(self, ngram):
+		'''
+		retrieve stored values of given n-gram.
+		@param ngram (tuple) word ids
+		@return (prob, backoff) or None if the n-gram is not stored.
+		'''
+		
+		return self.__table.get(ngram)
+
+
+	def nbytes(self):
+		'''
+		retrieve approximate bytes used by the table.
+		'''
+		
+		ret = sys.getsizeof(self.__table)
+		for ngram, values in self.__table.items():
+			ret += sys.getsizeof(ngram) + sys.getsizeof(values) + sum(sys.getsizeof(x) for x in values)
+		return ret
+
+
+class _ArrayTable:
+	'''
+	n-gram table holding each order in sorted, array-backed columns.
+	order 1 is indexed directly by word id.
+	order n (> 1) is sorted by the packed key (context << 32 | word id),
+	where context is the index of the (n-1)-gram prefix in order n-1,
+	and is searched by bisection.
+	probs and backoffs are stored as float32, or as 8/16-bit codes of
+	per-order codebooks for orders > 1 if quantized.
+	n-grams whose prefix is not stored get a placeholder entry with NaN
+	probability, so that every stored n-gram is reachable from its prefix.
+	'''
+
+	def __init__(self, default_backoff):
+		self.__backoff = default_backoff
+		self.__raw = [] # [order - 1] -> ([word ids] * order, probs, backoffs)
+		self.__keys = []
+		self.__probs = []
+		self.__backoffs = []
+		self.__books = [] # [order - 1] -> (prob codebook, backoff codebook) or None
+
+
+	def __raw_order(self, n):
+		while len(self.__raw) < n:
+			m = len(self.__raw) + 1
+			self.__raw.append(([array('l') for i in range(m)], array('f'), array('f')))
+		return self.__raw[n-1]
+
+
+	def add(self, ngram, prob, backoff):
+		cols, probs, backoffs = self.__raw_order(len(ngram))
+		for col, w in zip(cols, ngram):
+			col.append(w)
+		probs.append(prob)
+		backoffs.append(backoff)
+
+
+	def add_columns(self, cols, probs, backoffs):
+		'''
+		add n-grams of the same order given as columns.
+		@param cols list of word id columns
+		@param probs column of probs
+		@param backoffs column of backoffs
+		'''
+		
+		raw_cols, raw_probs, raw_backoffs = self.__raw_order(len(cols))
+		for raw_col, col in zip(raw_cols, cols):
+			raw_col.extend(iter(col))
+		raw_probs.extend(iter(probs))
+		raw_backoffs.extend(iter(backoffs))
+
+
+	def finalize(self, vocab_size):
+		while True:
+			missing = self.__build(vocab_size)
+			if not missing:
+				break
+			for ngram in missing:
+				self.add(ngram, float('nan'), self.__backoff)
+		self.__raw = None
+
+
+	def __build(self, vocab_size):
+		'''
+		build sorted columns from raw columns.
+		@return (set) prefixes which are not stored.
+		'''
+		
+		self.__keys = [None]
+		self.__probs = [array('f', [float('nan')]) * vocab_size]
+		self.__backoffs = [array('f', [self.__backoff]) * vocab_size]
+		self.__books = [None]
+		
+		if not self.__raw:
+			return set()
+		
+		cols, probs, backoffs = self.__raw[0]
+		for w, prob, backoff in zip(cols[0], probs, backoffs):
+			self.__probs[0][w] = prob
+			self.__backoffs[0][w] = backoff
+		
+		for n in range(2, len(self.__raw) + 1):
+			cols, probs, backoffs = self.__raw[n-1]
+			
+			# indices of prefixes in order n-1, walking from unigrams
+			contexts = cols[0]
+			for m in range(2, n):
+				contexts = self.__lookup(m, contexts, cols[m-1])
+			if -1 in contexts:
+				return set(row[:-1] for row, context in zip(zip(*cols), contexts) if context < 0)
+			
+			# sort by key; the last one wins if the same n-gram appears twice
+			keys = array('q', map(or_, map(lshift, contexts, repeat(32)), cols[n-1]))
+			perm = sorted(range(len(keys)), key=keys.__getitem__)
+			sorted_keys = array('q', map(keys.__getitem__, perm))
+			if any(map(eq, sorted_keys, islice(sorted_keys, 1, None))):
+				perm = [i for j, i in enumerate(perm) if j+1 == len(perm) or keys[i] != keys[perm[j+1]]]
+				sorted_keys = array('q', map(keys.__getitem__, perm))
+			self.__keys.append(sorted_keys)
+			self.__probs.append(array('f', map(probs.__getitem__, perm)))
+			self.__backoffs.append(array('f', map(backoffs.__getitem__, perm)))
+			self.__books.append(None)
+		
+		return set()
+
+
+	def quantize(self, bits):
+		'''
+		replace probs and backoffs of orders > 1 with codes of per-order codebooks.
+		@param bits (int) bits of each code: 8 or 16
+		'''
+		
+		typecode = _QUANTIZE_TYPECODES[bits]
+		for n in range(1, len(self.__probs)):
+			prob_book, self.__probs[n] = _quantize(self.__probs[n], bits, typecode)
+			backoff_book, self.__backoffs[n] = _quantize(self.__backoffs[n], bits, typecode)
+			self.__books[n] = (prob_book, backoff_book)
+
+
+	def __lookup(self, n, contexts, wids):
+		'''
+		bulk version of _ArrayTable.child() for built orders.
+		@param n (int) order of n-grams to look up
+		@param contexts iterable of indices of (n-1)-grams
+		@param wids iterable of word ids appended to contexts
+		@return (list) indices of n-grams, or -1 if not found.
+		'''
+		
+		keys = self.__keys[n-1]
+		packed = list(map(or_, map(lshift, contexts, repeat(32)), wids))
+		if not keys:
+			return [-1] * len(packed)
+		found = list(map(bisect_left, repeat(keys), packed, repeat(0), repeat(len(keys) - 1)))
+		matched = list(map(eq, map(keys.__getitem__, found), packed))
+		if all(matched):
+			return found
+		return [i if m else -1 for i, m in zip(found, matched)]
+
+
+	def __find(self, ngram):
+		'''
+		retrieve index of given n-gram in its order, or -1 if not found.
+		'''
+		
+		if not ngram or ngram[0] >= len(self.__probs[0]):
+			return -1
+		index = ngram[0]
+		for n in range(1, len(ngram)):
+			if n >= len(self.__keys):
+				return -1
+			keys = self.__keys[n]
+			key = index << 32 | ngram[n]
+			index = bisect_left(keys, key)
+			if index == len(keys) or keys[index] != key:
+				return -1
+		return index
+
+
+	def get(self, ngram):
+		'''
+		retrieve stored values of given n-gram.
+		@param ngram (tuple) word ids
+		@return (prob, backoff) or None if the n-gram is not stored.
+		'''
+		
+		return self.entry(len(ngram), self.__find(ngram))
+
+
+	def root(self):
+		'''
+		retrieve handle of the empty n-gram.
+		handles are indices in each order, and -1 describes an unreachable n-gram.
+		'''
+		
+		return 0
+
+
+	def child(self, n, handle, wid):
+		'''
+		retrieve handle of the n-gram made by appending a word to the (n-1)-gram of given handle.
+		'''
+		
+		if handle < 0 or n > len(self.__probs):
+			return -1
+		if n == 1:
+			return wid if wid < len(self.__probs[0]) else -1
+		keys = self.__keys[n-1]
+		key = handle << 32 | wid
+		index = bisect_left(keys, key)
+		if index == len(keys) or keys[index] != key:
+			return -1
+		return index
+
+
+	def entry(self, n, handle):
+		'''
+		retrieve stored values of the n-gram of given handle.
+		@return (prob, backoff) or None if the n-gram is not stored.
+		'''
+		
+		if handle < 0:
+			return None
+		prob = self.__probs[n-1][handle]
+		backoff = self.__backoffs[n-1][handle]
+		books = self.__books[n-1]
+		if books is not None:
+			prob = books[0][prob]
+			backoff = books[1][backoff]
+		if prob != prob:
+			# placeholder
+			return None
+		return (prob, backoff)
+
+
+	def items(self):
+		'''
+		iterate over stored n-grams order by order.
+		@return iterator of ((word ids), (prob, backoff))
+		'''
+		
+		prev = None
+		for n in range(1, len(self.__probs) + 1):
+			if n == 1:
+				ngrams = [(w,) for w in range(len(self.__probs[0]))]
+			else:
+				ngrams = [prev[key >> 32] + (key & 0xffffffff,) for key in self.__keys[n-1]]
+			for index, ngram in enumerate(ngrams):
+				entry = self.entry(n, index)
+				if entry is not None:
+					yield ngram, entry
+			prev = ngrams
+
+
+	def columns(self):
+		'''
+		retrieve sorted columns.
+		@return (keys, probs, backoffs, books): lists of columns for each order
+			(keys[0] is None, and books[n] is None if order n+1 is not quantized).
+		'''
+		
+		return self.__keys, self.__probs, self.__backoffs, self.__books
+
+
+	def set_columns(self, keys, probs, backoffs, books):
+		'''
+		replace sorted columns with those built beforehand (e.g. views of a binary file).
+		'''
+		
+		self.__keys = keys
+		self.__probs = probs
+		self.__backoffs = backoffs
+		self.__books = books
+		self.__raw = None
+
+
+	def count(self):
+		'''
+		retrieve number of stored n-grams, excluding placeholders and unused unigram slots.
+		'''
+		
+		ret = 0
+		for probs, books in zip(self.__probs, self.__books):
+			if books is not None:
+				# code 0 describes NaN
+				ret += sum(map(bool, probs))
+			else:
+				ret += len(probs) - sum(map(ne, probs, probs))
+		return ret
+
+
+	def nbytes(self):
+		'''
+		retrieve bytes used by the columns.
+		'''
+		
+		columns = self.__keys[1:] + self.__probs + self.__backoffs
+		columns += [x for books in self.__books if books is not None for x in books]
+		return sum(memoryview(x).nbytes for x in columns)
+
+
+class _MappedVocab:
+	'''
+	read-only vocabulary stored in a binary LM file.
+	words are looked up by bisection over the ids sorted by word bytes.
+	'''
+
+	def __init__(self, buf, base, offsets, sorted_ids, encoding):
+		self.__buf = buf
+		self.__base = base
+		self.__offsets = offsets
+		self.__sorted_ids = sorted_ids
+		self.__encoding = encoding
+		self.__cache = {}
+
+
+	def __len__(self):
+		return len(self.__sorted_ids)
+
+
+	def word_bytes(self, wid):
+		return self.__buf[self.__base+self.__offsets[wid]:self.__base+self.__offsets[wid+1]]
+
+
+	def get(self, word, default=None):
+		'''
+		retrieve word id, or default for unknown words.
+		'''
+		
+		wid = self.__cache.get(word)
+		if wid is not None:
+			return wid
+		key = word.encode(self.__encoding)
+		ids = self.__sorted_ids
+		lo, hi = 0, len(ids)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.word_bytes(ids[mid]) < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		if lo < len(ids) and self.word_bytes(ids[lo]) == key:
+			wid = ids[lo]
+			self.__cache[word] = wid
+			return wid
+		return default
+
+
+	def items(self):
+		for wid in range(len(self)):
+			yield self.word_bytes(wid).decode(self.__encoding), wid
 
 
 class LM:
@@ -23,6 +568,10 @@ class LM:
 	ARPA formatted language model (LM)
 	'''
 
+	BINARY_MAGIC = b'ARPABIN2'
+	BINARY_BOM = 0x01020304
+	BINARY_HEADER = '=IIIxxxxQQdd' # bom, maxn, quantization bits, vocab size, n-grams, default backoff, unknown bias
+
 	def __init__(self, filepath, **kwargs):
 		'''
 		initialize LM object.
@@ -31,11 +580,27 @@ class LM:
 		@param [kwargs]encoding (str) encoding of ARPA file (default: 'utf-8')
 		@param [kwargs]default_backoff (Real) default backoff corfficient (default: -5.0)
 		@param [kwargs]unknown_bias (Real) bias for log-probability of unknown word (default: 0.0)
+		@param [kwargs]storage (str) storage engine of n-grams (default: 'dict')
+			'dict': Python dict keyed by tuples of word ids (fastest to build)
+			'array': sorted float32 columns for each order (several times smaller)
+		@param [kwargs]quantize (int) bits of quantized probs and backoffs of orders > 1
+			for 'array' storage: 8, 16, or 0 to store float32 (default: 0)
+		@param [kwargs]cache_size (int) max number of memoized results for each of
+			condprob() and score()/jointprob(), or 0 to disable memoization (default: 0)
+		@param [kwargs]workers (int) number of processes parsing n-gram sections (default: 1)
 		'''
 		
 		DEFAULT_ENCODING = 'utf-8'
 		DEFAULT_BACKOFF = -5.0
 		DEFAULT_UNK_BIAS = 0.0
+		DEFAULT_STORAGE = 'dict'
+		DEFAULT_CACHE_SIZE = 0
+		DEFAULT_QUANTIZE = 0
+		DEFAULT_WORKERS = 1
+		STORAGES = {
+			'dict': _DictTable,
+			'array': _ArrayTable,
+		}
 		
 		def getkwarg(key, type, default):
 			if key in kwargs and isinstance(kwargs[key], type):
@@ -46,23 +611,36 @@ class LM:
 		encoding = getkwarg('encoding', str, DEFAULT_ENCODING)
 		self.__backoff = float(getkwarg('default_backoff', Real, DEFAULT_BACKOFF))
 		self.__unk = float(getkwarg('unknown_bias', Real, DEFAULT_UNK_BIAS))
-		self.__wid = defaultdict(lambda: len(self.__wid))
+		self.__has_unk = False
+		storage = getkwarg('storage', str, DEFAULT_STORAGE)
+		if storage not in STORAGES:
+			raise ValueError('storage must be one of: ' + ', '.join(sorted(STORAGES)))
+		quantize = getkwarg('quantize', int, DEFAULT_QUANTIZE)
+		if quantize and (quantize not in _QUANTIZE_TYPECODES or storage != 'array'):
+			raise ValueError('quantize must be 8 or 16 with \'array\' storage.')
 		self.__maxn = 0
+		self.__table = STORAGES[storage](self.__backoff)
 		
-		self.__table = {}
-		with open(filepath, encoding=encoding) as fp:
-			for line in fp:
-				ls = line.strip().split('\t')
-				if not (2 <= len(ls) <= 3) or ls[0] == 'ngram':
-					continue
-				elif ls[1] == '<unk>':
-					self.__unk += float(ls[0])
-				else:
-					prob = float(ls[0])
-					ngram = tuple(self.__wid[x] for x in tuple(ls[1].split(' ')))
-					backoff = float(ls[2]) if len(ls) == 3 else self.__backoff
-					self.__table[ngram] = (prob, backoff)
-					self.__maxn = max(self.__maxn, len(ngram))
+		begin = time.time()
+		vocab = {}
+		with open(filepath, 'rb') as fp:
+			size = os.fstat(fp.fileno()).st_size
+			if size > 0:
+				buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+				with buf:
+					ngrams = self.__parse(buf, vocab, getkwarg('workers', int, DEFAULT_WORKERS))
+			else:
+				ngrams = 0
+		self.__table.finalize(len(vocab))
+		if quantize:
+			self.__table.quantize(quantize)
+		
+		self.__load_info = LoadInfo(ngrams, size, time.time() - begin)
+		
+		# vocabulary is read-only after loading: unknown words share one id out of the table.
+		self.__wid = {word.decode(encoding): wid for word, wid in vocab.items()}
+		self.__unk_id = len(self.__wid)
+		self.__init_cache(getkwarg('cache_size', int, DEFAULT_CACHE_SIZE))
 		
 #		print('backoff', self.__backoff)
 #		print('unk', self.__unk)
@@ -70,6 +648,138 @@ class LM:
 #			print(k,v)
 
 
+	def __parse(self, buf, vocab, workers):
+		'''
+		parse ARPA file.
+		n-gram sections following the \\data\\ header are parsed in blocks, which are handed to
+		worker processes if workers > 1. files without the header are parsed line by line.
+		@param buf (mmap) content of ARPA file
+		@param vocab (dict) vocabulary to be filled: (bytes) word -> word id
+		@param workers (int) number of parser processes
+		@return (int) number of parsed n-grams
+		'''
+		
+		global _parse_buf, _parse_vocab
+		
+		sections = _find_sections(buf)
+		if sections is None:
+			return self.__parse_lines(iter(buf.readline, b''), vocab)
+		
+		# unigrams define the vocabulary
+		ngrams = 0
+		tasks = []
+		for n, begin, end in sections:
+			if n == 1:
+				ngrams += self.__parse_lines(buf[begin:end].split(b'\n'), vocab)
+			else:
+				while begin < end:
+					split = min(begin + _PARSE_BLOCK_SIZE, end)
+					if split < end:
+						split = buf.find(b'\n', split, end) + 1 or end
+					tasks.append((n, begin, split))
+					begin = split
+		vocab.setdefault(b'<unk>', len(vocab))
+		
+		_parse_buf = buf
+		_parse_vocab = vocab
+		pool = None
+		try:
+			if workers > 1 and len(tasks) > 1:
+				pool = multiprocessing.get_context('fork').Pool(workers)
+				results = pool.imap(_parse_block, tasks)
+			else:
+				results = map(_parse_block, tasks)
+			for (n, begin, end), columns in results:
+				if columns is None:
+					ngrams += self.__parse_lines(buf[begin:end].split(b'\n'), vocab)
+					continue
+				cols, probs, backoffs = columns
+				if backoffs is None:
+					# one float object shared by all rows
+					backoffs = [self.__backoff] * len(probs)
+				self.__table.add_columns(cols, probs, backoffs)
+				self.__maxn = max(self.__maxn, n)
+				ngrams += len(probs)
+		finally:
+			if pool is not None:
+				pool.terminate()
+			_parse_buf = None
+			_parse_vocab = None
+		
+		return ngrams
+
+
+	def __parse_lines(self, lines, vocab):
+		'''
+		parse ARPA lines one by one, adding new words to the vocabulary.
+		@param lines iterable of bytes
+		@param vocab (dict) vocabulary: (bytes) word -> word id
+		@return (int) number of parsed n-grams
+		'''
+		
+		ngrams = 0
+		for line in lines:
+			ls = line.strip().split(b'\t')
+			if not (2 <= len(ls) <= 3) or ls[0] == b'ngram':
+				continue
+			elif ls[1] == b'<unk>':
+				self.__unk += float(ls[0])
+				self.__has_unk = True
+			else:
+				prob = float(ls[0])
+				ngram = tuple(vocab.setdefault(x, len(vocab)) for x in ls[1].split(b' '))
+				backoff = float(ls[2]) if len(ls) == 3 else self.__backoff
+				self.__table.add(ngram, prob, backoff)
+				self.__maxn = max(self.__maxn, len(ngram))
+				ngrams += 1
+		return ngrams
+
+
+	def load_info(self):
+		'''
+		retrieve statistics of parsing ARPA file.
+		@return (LoadInfo) named tuple of parsed n-grams, bytes of the file and elapsed seconds.
+		'''
+		
+		return self.__load_info
+
+
+	def __init_cache(self, size):
+		'''
+		set up LRU caches of LM.__condprob_inner() and LM.__score_inner().
+		'''
+		
+		self.__cache_size = size
+		if size > 0:
+			self.__condprob_cached = lru_cache(maxsize=size)(self.__condprob_inner)
+			self.__score_cached = lru_cache(maxsize=size)(self.__score_inner)
+		else:
+			self.__condprob_cached = self.__condprob_inner
+			self.__score_cached = self.__score_inner
+
+
+	def cache_info(self):
+		'''
+		retrieve statistics of memoized queries, summed over condprob() and score()/jointprob().
+		@return (CacheInfo) named tuple of hits, misses, maxsize and currsize.
+		'''
+		
+		if self.__cache_size <= 0:
+			return CacheInfo(0, 0, 0, 0)
+		infos = (self.__condprob_cached.cache_info(), self.__score_cached.cache_info())
+		return CacheInfo(*(sum(x) for x in zip(*infos)))
+
+
+	def cache_clear(self):
+		'''
+		clear memoized queries and their statistics.
+		'''
+		
+		if self.__cache_size > 0:
+			self.__condprob_cached.cache_clear()
+			self.__score_cached.cache_clear()
+
+
 	def __condprob_inner(self, ngram):
 		'''
 		inner calculation for LM.condprob()
@@ -77,9 +787,10 @@ class LM:
 		
 #		print(ngram)
 	
-		if ngram in self.__table:
+		entry = self.__table.get(ngram)
+		if entry is not None:
 			# stored n-gram
-			return self.__table[ngram][0]
+			return entry[0]
 		else:
 			if len(ngram) == 1:
 				# unknown unigram
@@ -87,13 +798,23 @@ class LM:
 			else:
 				# backoff
 				prob = self.__condprob_inner(ngram[1:len(ngram)])
-				context = ngram[0:len(ngram)-1]
-				if context in self.__table:
-					return prob + self.__table[context][1]
+				context = self.__table.get(ngram[0:len(ngram)-1])
+				if context is not None:
+					return prob + context[1]
 				else:
 					return prob + self.__backoff
 
 
+	def has_unknown(self):
+		'''
+		retrieve whether the probability of unknown words is stored in the file,
+		i.e. the ARPA file has the unigram '<unk>', or the file is binary.
+		@return (bool) True if the probability of unknown words is stored.
+		'''
+		
+		return self.__has_unk
+
+
 	def maxn(self):
 		'''
 		retrieve max length of stored n-gram.
@@ -103,6 +824,60 @@ class LM:
 		return self.__maxn
 
 
+	def default_backoff(self):
+		'''
+		retrieve backoff coefficient used for contexts which are not stored.
+		@return (float) default backoff coefficient.
+		'''
+		
+		return self.__backoff
+
+
+	def ngrams(self):
+		'''
+		iterate over stored n-grams.
+		the log-probability of unknown words (including unknown_bias) is given as the unigram '<unk>'.
+		@return iterator of (words, prob, backoff): (tuple of str, float, float)
+		'''
+		
+		words = [None] * self.__unk_id
+		for word, wid in self.__wid.items():
+			words[wid] = word
+		yield ('<unk>',), self.__unk, self.__backoff
+		for ngram, (prob, backoff) in self.__table.items():
+			yield tuple(words[x] for x in ngram), prob, backoff
+
+
+	def save_arpa(self, filepath):
+		'''
+		write LM as an ARPA file.
+		@param filepath (str) path of the ARPA file
+		'''
+		
+		write_arpa(filepath, self.ngrams())
+
+
+	def nbytes(self):
+		'''
+		retrieve bytes used by the n-gram storage (approximate for 'dict' storage).
+		@return (int) bytes used by the n-gram storage.
+		'''
+		
+		return self.__table.nbytes()
+
+
+	def known(self, word):
+		'''
+		check whether given word has its own unigram.
+		@param word (str) word
+		@return (bool) True if the word is in the vocabulary, False otherwise.
+		'''
+		
+		table = self.__table
+		wid = self.__wid.get(word, self.__unk_id)
+		return table.entry(1, table.child(1, table.root(), wid)) is not None
+
+
 	def condprob(self, ngram):
 		'''
 		retrieve conditional log-probability of given n-gram:
@@ -119,7 +894,7 @@ class LM:
 		elif not isinstance(ngram, tuple):
 			raise TypeError('ngram must be str, tuple or list.')
 		
-		return self.__condprob_inner(tuple(self.__wid[x] for x in ngram))
+		return self.__condprob_cached(self.ids(ngram))
 
 
 	def jointprob(self, sentence):
@@ -139,13 +914,342 @@ class LM:
 		elif not isinstance(sentence, tuple):
 			raise TypeError('sentence must be str, tuple or list.')
 		
+		return self.jointprob_ids(self.ids(sentence))
+
+
+	def ids(self, words):
+		'''
+		convert words into word ids, which are accepted by LM.*_ids() methods.
+		unknown words are converted into the same id, and the vocabulary is not changed.
+		@param words iterable of str
+		@return (tuple) word ids
+		'''
+		
+		get = self.__wid.get
+		unk_id = self.__unk_id
+		return tuple(get(x, unk_id) for x in words)
+
+
+	def condprob_ids(self, ngram):
+		'''
+		same as LM.condprob(), but takes word ids.
+		@param ngram (tuple) word ids returned by LM.ids()
+		@return (float) value describing conditional log-probability of given n-gram.
+		'''
+		
+		return self.__condprob_cached(ngram)
+
+
+	def jointprob_ids(self, sentence):
+		'''
+		same as LM.jointprob(), but takes word ids.
+		@param sentence iterable of word ids returned by LM.ids()
+		@return (float) value describing joint log-probability of given sentence.
+		'''
+		
 		# sum conditional probabilities
-		k = self.__maxn
+		state = self.begin_sentence()
 		ret = 0
-		for i in range(len(sentence)):
-			ngram = tuple(self.__wid[x] for x in sentence[max(i-k+1, 0):i+1])
-			ret += self.__condprob_inner(ngram)
-			
-#			print(ngram)
+		for wid in sentence:
+			prob, state = self.__score_cached(state, wid)
+			ret += prob
+		
+		return ret
+
+
+	def begin_sentence(self, context=()):
+		'''
+		retrieve initial state for LM.score().
+		@param context tuple or list of str describing words preceding the sentence (default: nothing).
+		@return state object, which is hashable and comparable.
+		'''
+		
+		state = (self.__table.root(),)
+		for wid in self.ids(context):
+			state = self.__score_cached(state, wid)[1]
+		return state
+
+
+	def score(self, state, word):
+		'''
+		retrieve conditional log-probability of the next word and the state after it.
+		the sum of scores through a sentence from LM.begin_sentence() is equal to LM.jointprob().
+		@param state state object returned by LM.begin_sentence() or LM.score().
+		@param word (str) next word
+		@return (float, state) conditional log-probability of the word, and the next state.
+		'''
+		
+		return self.__score_cached(state, self.__wid.get(word, self.__unk_id))
+
+
+	def score_id(self, state, wid):
+		'''
+		same as LM.score(), but takes a word id.
+		@param state state object returned by LM.begin_sentence() or LM.score*().
+		@param wid (int) word id returned by LM.ids()
+		@return (float, state) conditional log-probability of the word, and the next state.
+		'''
+		
+		return self.__score_cached(state, wid)
+
+
+	def __score_inner(self, state, wid):
+		'''
+		inner calculation for LM.score()
+		state holds storage handles of every suffix of the context, shortest first,
+		so that the n-grams ending with the next word are reached without rebuilding id tuples.
+		'''
+		
+		table = self.__table
+		handles = [state[0]]
+		for n, handle in enumerate(state, 1):
+			handles.append(table.child(n, handle, wid))
 		
+		n = len(state)
+		while n > 0:
+			entry = table.entry(n, handles[n])
+			if entry is not None:
+				# stored n-gram
+				prob = entry[0]
+				break
+			n -= 1
+		else:
+			# unknown unigram
+			prob = self.__unk
+			n = 1
+		
+		# backoff
+		for m in range(n, len(state)):
+			context = table.entry(m, state[m])
+			prob += context[1] if context is not None else self.__backoff
+		
+		return prob, tuple(handles[:self.__maxn])
+
+
+	def save_binary(self, filepath):
+		'''
+		write LM as a binary file which can be loaded by LM.open_binary().
+		the file holds the sorted columns of 'array' storage in native byte order.
+		@param filepath (str) path of the binary file
+		'''
+		
+		if isinstance(self.__table, _ArrayTable):
+			table = self.__table
+		else:
+			table = _ArrayTable(self.__backoff)
+			for ngram, (prob, backoff) in self.__table.items():
+				table.add(ngram, prob, backoff)
+			table.finalize(len(self.__wid))
+		keys, probs, backoffs, books = table.columns()
+		quantized = len(books) > 1 and books[1] is not None
+		bits = 8 * memoryview(probs[1]).itemsize if quantized else 0
+		
+		vocab_size = len(probs[0])
+		words = [b''] * vocab_size
+		for word, wid in self.__wid.items():
+			if wid < vocab_size:
+				words[wid] = word.encode('utf-8')
+		offsets = array('q', [0])
+		for word in words:
+			offsets.append(offsets[-1] + len(word))
+		sorted_ids = array('q', sorted(range(vocab_size), key=words.__getitem__))
+		
+		def write_aligned(fp, data):
+			fp.write(data)
+			fp.write(b'\0' * (-len(data) % 8))
+		
+		with open(filepath, 'wb') as fp:
+			fp.write(LM.BINARY_MAGIC)
+			fp.write(struct.pack(LM.BINARY_HEADER,
+				LM.BINARY_BOM, len(probs), bits, vocab_size, table.count(), self.__backoff, self.__unk))
+			fp.write(array('q', [len(x) for x in probs]).tobytes())
+			fp.write(struct.pack('=Q', offsets[-1]))
+			write_aligned(fp, offsets.tobytes())
+			write_aligned(fp, sorted_ids.tobytes())
+			write_aligned(fp, b''.join(words))
+			for n in range(len(probs)):
+				if n > 0:
+					write_aligned(fp, bytes(keys[n]))
+				write_aligned(fp, bytes(probs[n]))
+				write_aligned(fp, bytes(backoffs[n]))
+				if books[n] is not None:
+					for book in books[n]:
+						padding = array('f', [float('nan')]) * ((1 << bits) - len(book))
+						write_aligned(fp, bytes(book) + bytes(padding))
+
+
+	@staticmethod
+	def open_binary(filepath, cache_size=0):
+		'''
+		load LM from a binary file written by LM.save_binary().
+		the file is mapped by mmap and no n-gram is read at load time,
+		so that processes using the same file share its pages.
+		@param filepath (str) path of the binary file
+		@param cache_size (int) same as LM.__init__()
+		@return (LM) LM object with read-only vocabulary
+		'''
+		
+		begin = time.time()
+		with open(filepath, 'rb') as fp:
+			buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		
+		if buf[:len(LM.BINARY_MAGIC)] != LM.BINARY_MAGIC:
+			raise ValueError('not a binary LM file: ' + filepath)
+		pos = len(LM.BINARY_MAGIC)
+		bom, maxn, bits, vocab_size, ngrams, backoff, unk = struct.unpack_from(LM.BINARY_HEADER, buf, pos)
+		if bom != LM.BINARY_BOM:
+			raise ValueError('byte order mismatch: ' + filepath)
+		pos += struct.calcsize(LM.BINARY_HEADER)
+		counts = array('q', buf[pos:pos+8*maxn])
+		pos += 8 * maxn
+		blob_size, = struct.unpack_from('=Q', buf, pos)
+		pos += 8
+		
+		view = memoryview(buf)
+		def read_aligned(size, typecode):
+			nonlocal pos
+			ret = view[pos:pos+size]
+			pos += size + (-size % 8)
+			return ret.cast(typecode)
+		
+		offsets = read_aligned(8 * (vocab_size+1), 'q')
+		sorted_ids = read_aligned(8 * vocab_size, 'q')
+		blob_pos = pos
+		read_aligned(blob_size, 'B')
+		keys = [None]
+		probs = []
+		backoffs = []
+		books = []
+		for n in range(maxn):
+			if n > 0:
+				keys.append(read_aligned(8 * counts[n], 'q'))
+			if n > 0 and bits:
+				typecode = _QUANTIZE_TYPECODES[bits]
+				probs.append(read_aligned(bits // 8 * counts[n], typecode))
+				backoffs.append(read_aligned(bits // 8 * counts[n], typecode))
+				books.append(tuple(read_aligned(4 << bits, 'f') for i in range(2)))
+			else:
+				probs.append(read_aligned(4 * counts[n], 'f'))
+				backoffs.append(read_aligned(4 * counts[n], 'f'))
+				books.append(None)
+		
+		ret = LM.__new__(LM)
+		ret.__backoff = backoff
+		ret.__unk = unk
+		ret.__has_unk = True
+		ret.__wid = _MappedVocab(buf, blob_pos, offsets, sorted_ids, 'utf-8')
+		ret.__unk_id = vocab_size
+		ret.__maxn = maxn
+		ret.__table = _ArrayTable(backoff)
+		ret.__table.set_columns(keys, probs, backoffs, books)
+		ret.__init_cache(cache_size)
+		ret.__load_info = LoadInfo(ngrams, len(buf), time.time() - begin)
 		return ret
+
+
+def write_arpa(filepath, ngrams):
+	'''
+	write n-grams as an ARPA file.
+	backoffs of the highest order are omitted.
+	@param filepath (str) path of the ARPA file
+	@param ngrams iterable of (words, prob, backoff) such as LM.ngrams()
+	'''
+	
+	orders = []
+	for words, prob, backoff in ngrams:
+		while len(orders) < len(words):
+			orders.append([])
+		orders[len(words)-1].append((words, prob, backoff))
+	
+	with open(filepath, 'w', encoding='utf-8') as fp:
+		print('\\data\\', file=fp)
+		for n, entries in enumerate(orders, 1):
+			print('ngram %d=%d' % (n, len(entries)), file=fp)
+		for n, entries in enumerate(orders, 1):
+			print('\n\\%d-grams:' % n, file=fp)
+			for words, prob, backoff in entries:
+				if n < len(orders):
+					print('%.7g\t%s\t%.7g' % (prob, ' '.join(words), backoff), file=fp)
+				else:
+					print('%.7g\t%s' % (prob, ' '.join(words)), file=fp)
+		print('\n\\end\\', file=fp)
+
+
+def prune(lm, max_entries):
+	'''
+	prune n-grams by relative entropy (Stolcke, 1998) down to given number of entries.
+	only n-grams (n > 1) which are not prefixes of other n-grams are removed, those increasing
+	relative entropy least first, and backoffs of all contexts are recomputed so that
+	conditional probabilities still sum up to 1.
+	@param lm (LM) LM object
+	@param max_entries (int) max number of n-grams (including unigrams) to keep
+	@return (list) remaining n-grams as (words, prob, backoff), which can be written by write_arpa().
+		'<unk>' is included only if lm.has_unknown().
+	'''
+	
+	EPSILON = 1e-30
+	
+	default_backoff = lm.default_backoff()
+	maxn = lm.maxn()
+	table = {words: [prob, backoff] for words, prob, backoff in lm.ngrams()}
+	unk = table.pop(('<unk>',))[0]
+	children = defaultdict(set)
+	for words in table:
+		if len(words) > 1:
+			children[words[:-1]].add(words[-1])
+	
+	def condprob(words):
+		entry = table.get(words)
+		if entry is not None:
+			return entry[0]
+		elif len(words) == 1:
+			return unk
+		context = table.get(words[:-1])
+		return condprob(words[1:]) + (context[1] if context is not None else default_backoff)
+	
+	def jointprob(words):
+		return sum(condprob(words[max(i-maxn+1, 0):i+1]) for i in range(len(words)))
+	
+	def mass(context):
+		# probabilities of explicit extensions of the context, and those of its backoff distribution
+		num = 1.0 - sum(10.0 ** table[context + (w,)][0] for w in children[context])
+		den = 1.0 - sum(10.0 ** condprob(context[1:] + (w,)) for w in children[context])
+		return max(num, EPSILON), max(den, EPSILON)
+	
+	def delta_entropy(words, masses, histories):
+		context = words[:-1]
+		if context not in masses:
+			masses[context] = mass(context)
+			histories[context] = 10.0 ** jointprob(context)
+		num, den = masses[context]
+		p = 10.0 ** table[words][0]
+		q = 10.0 ** condprob(words[1:])
+		backoff = num / den
+		new_backoff = (num + p) / (den + q)
+		return -histories[context] * (
+			p * (math.log(new_backoff * q) - math.log(p)) +
+			num * (math.log(new_backoff) - math.log(backoff)))
+	
+	# remove leaves from the least important, until the model is small enough
+	while len(table) + 1 > max_entries:
+		leaves = [words for words in table if len(words) > 1 and not children.get(words)]
+		if not leaves:
+			break
+		masses = {}
+		histories = {}
+		leaves.sort(key=lambda words: delta_entropy(words, masses, histories))
+		for words in leaves[:len(table) + 1 - max_entries]:
+			del table[words]
+			children[words[:-1]].discard(words[-1])
+	
+	# recompute backoffs, lower orders first.
+	# not only contexts of removed n-grams are affected: the backoff distribution of a context
+	# depends on its suffix, which may have lost its children (like SRILM, all of them are recomputed).
+	for context in sorted(children, key=len):
+		if context in table:
+			num, den = mass(context)
+			table[context][1] = math.log10(num / den)
+	
+	ret = [(('<unk>',), unk, default_backoff)] if lm.has_unknown() else []
+	ret += [(words, prob, backoff) for words, (prob, backoff) in table.items()]
+	return ret
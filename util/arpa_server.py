@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+
+'''
+LM scoring server and client sharing one ARPA formatted LM among processes.
+requests and responses are JSON lines over a Unix domain socket or localhost TCP:
+	{"id": 1, "op": "jointprob", "args": [["this", "is"], ["a", "pen"]]}
+	{"id": 1, "result": [-5.1, -7.3]}
+USAGE:
+	# server
+	import arpa, arpa_server
+	lm = arpa.LM.open_binary('your_lm.bin')
+	arpa_server.Server(lm).run(path='/tmp/lm.sock')
+
+	# client
+	with arpa_server.Client(path='/tmp/lm.sock') as client:
+		cp = client.condprob(ngram)
+		jps = client.jointprob_batch(sentences)
+'''
+
+
+import asyncio
+import json
+import socket
+from collections import deque
+
+
+class Server:
+	'''
+	asyncio server answering condprob/jointprob requests with one LM.
+	requests arriving together from any connections are coalesced into one batch,
+	in which identical queries are computed once.
+	'''
+
+	OPS = ('condprob', 'jointprob')
+	DEFAULT_MAX_BATCH = 1024
+	LINE_LIMIT = 1 << 26
+
+	def __init__(self, lm, max_batch=DEFAULT_MAX_BATCH):
+		'''
+		initialize Server object.
+		@param lm (arpa.LM) LM object
+		@param max_batch (int) max number of requests coalesced into one batch
+		'''
+
+		self.__lm = lm
+		self.__max_batch = max_batch
+		self.__queue = None
+		self.__requests = 0
+		self.__batches = 0
+
+
+	def stats(self):
+		'''
+		retrieve statistics of processed requests.
+		@return (int, int) number of requests and number of batches.
+		'''
+
+		return self.__requests, self.__batches
+
+
+	def run(self, path=None, host='127.0.0.1', port=None):
+		'''
+		serve until interrupted.
+		@param path (str) path of Unix domain socket, or None to use TCP
+		@param host (str) host of TCP socket
+		@param port (int) port of TCP socket
+		'''
+
+		asyncio.run(self.serve(path, host, port))
+
+
+	async def serve(self, path=None, host='127.0.0.1', port=None):
+		'''
+		coroutine version of Server.run().
+		'''
+
+		self.__queue = asyncio.Queue()
+		if path is not None:
+			server = await asyncio.start_unix_server(self.__handle, path=path, limit=Server.LINE_LIMIT)
+		else:
+			server = await asyncio.start_server(self.__handle, host, port, limit=Server.LINE_LIMIT)
+		batcher = asyncio.ensure_future(self.__batcher())
+		try:
+			async with server:
+				await server.serve_forever()
+		finally:
+			batcher.cancel()
+
+
+	async def __batcher(self):
+		'''
+		process queued requests batch by batch.
+		'''
+
+		while True:
+			batch = [await self.__queue.get()]
+			# let readers of other connections enqueue their requests
+			await asyncio.sleep(0)
+			while len(batch) < self.__max_batch and not self.__queue.empty():
+				batch.append(self.__queue.get_nowait())
+
+			memo = {}
+			for request, future in batch:
+				if not future.cancelled():
+					future.set_result(self.__process(request, memo))
+			self.__requests += len(batch)
+			self.__batches += 1
+
+
+	def __process(self, request, memo):
+		'''
+		compute response of a request.
+		@param request (dict) decoded request
+		@param memo (dict) results in the current batch: (op, words) -> float
+		@return (dict) response
+		'''
+
+		try:
+			op = request['op']
+			if op not in Server.OPS:
+				raise ValueError('unknown op: %s' % op)
+			method = getattr(self.__lm, op)
+			result = []
+			for words in request['args']:
+				# a string is one word, as in arpa.LM.condprob() and arpa.LM.jointprob()
+				key = (op, (words,) if isinstance(words, str) else tuple(words))
+				if key not in memo:
+					memo[key] = method(key[1])
+				result.append(memo[key])
+			return {'id': request.get('id'), 'result': result}
+		except Exception as ex:
+			return {'id': request.get('id') if isinstance(request, dict) else None, 'error': '%s: %s' % (type(ex).__name__, ex)}
+
+
+	async def __handle(self, reader, writer):
+		'''
+		read requests of a connection and enqueue them.
+		responses are written in the order of requests, so clients can pipeline them.
+		'''
+
+		loop = asyncio.get_running_loop()
+		pending = asyncio.Queue()
+		sender = asyncio.ensure_future(self.__send(pending, writer))
+		try:
+			async for line in reader:
+				future = loop.create_future()
+				try:
+					self.__queue.put_nowait((json.loads(line), future))
+				except ValueError as ex:
+					future.set_result({'id': None, 'error': 'ValueError: %s' % ex})
+				pending.put_nowait(future)
+		finally:
+			pending.put_nowait(None)
+			await sender
+			writer.close()
+
+
+	async def __send(self, pending, writer):
+		'''
+		write responses of a connection in order.
+		'''
+
+		while True:
+			future = await pending.get()
+			if future is None:
+				break
+			writer.write(json.dumps(await future).encode('utf-8') + b'\n')
+			if pending.empty():
+				await writer.drain()
+
+
+class Client:
+	'''
+	blocking client of Server.
+	batches are pipelined: up to `window` requests are sent before reading their responses.
+	'''
+
+	DEFAULT_BATCH_SIZE = 256
+	DEFAULT_WINDOW = 16
+
+	def __init__(self, path=None, host='127.0.0.1', port=None):
+		'''
+		connect to Server.
+		@param path (str) path of Unix domain socket, or None to use TCP
+		@param host (str) host of TCP socket
+		@param port (int) port of TCP socket
+		'''
+
+		if path is not None:
+			self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.__sock.connect(path)
+		else:
+			self.__sock = socket.create_connection((host, port))
+		self.__rfile = self.__sock.makefile('rb')
+		self.__next_id = 0
+
+
+	def close(self):
+		self.__rfile.close()
+		self.__sock.close()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *args):
+		self.close()
+
+
+	def condprob(self, ngram):
+		'''
+		same as arpa.LM.condprob().
+		'''
+
+		return self.condprob_batch([ngram])[0]
+
+
+	def jointprob(self, sentence):
+		'''
+		same as arpa.LM.jointprob().
+		'''
+
+		return self.jointprob_batch([sentence])[0]
+
+
+	def condprob_batch(self, ngrams, batch_size=DEFAULT_BATCH_SIZE, window=DEFAULT_WINDOW):
+		'''
+		retrieve conditional log-probabilities of many n-grams.
+		@param ngrams list of n-grams (tuple or list of str, or str)
+		@param batch_size (int) number of n-grams in one request
+		@param window (int) max number of requests waiting for responses
+		@return (list) conditional log-probabilities
+		'''
+
+		return self.__call('condprob', ngrams, batch_size, window)
+
+
+	def jointprob_batch(self, sentences, batch_size=DEFAULT_BATCH_SIZE, window=DEFAULT_WINDOW):
+		'''
+		retrieve joint log-probabilities of many sentences.
+		@param sentences list of sentences (tuple or list of str, or str)
+		@param batch_size (int) number of sentences in one request
+		@param window (int) max number of requests waiting for responses
+		@return (list) joint log-probabilities
+		'''
+
+		return self.__call('jointprob', sentences, batch_size, window)
+
+
+	def __call(self, op, items, batch_size, window):
+		items = [[x] if isinstance(x, str) else list(x) for x in items]
+		ret = []
+		in_flight = deque()
+		for i in range(0, len(items), batch_size):
+			request = {'id': self.__next_id, 'op': op, 'args': items[i:i+batch_size]}
+			self.__sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+			in_flight.append(self.__next_id)
+			self.__next_id += 1
+			if len(in_flight) >= window:
+				ret += self.__receive(in_flight.popleft())
+		while in_flight:
+			ret += self.__receive(in_flight.popleft())
+		return ret
+
+
+	def __receive(self, request_id):
+		line = self.__rfile.readline()
+		if not line:
+			raise ConnectionError('connection closed by server')
+		response = json.loads(line)
+		if 'error' in response:
+			raise RuntimeError(response['error'])
+		if response['id'] != request_id:
+			raise RuntimeError('unexpected response id: %s' % response['id'])
+		return response['result']
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+'''
+n-gram count files made by count_ngram.py.
+text format: one "n-gram<TAB>count" per line.
+binary format: MAGIC followed by records of
+    uint32 length, utf-8 bytes of n-gram, uint64 count
+in little endian, sorted by bytes of n-grams.
+sorted files of both formats can be merged without loading them into memory.
+'''
+
+import heapq
+import itertools
+import struct
+
+
+MAGIC = b'NGCOUNT1'
+
+_LENGTH = struct.Struct('<I')
+_COUNT = struct.Struct('<Q')
+
+
+def read_text(fp):
+    for l in fp:
+        k, v = l.rsplit('\t', 1)
+        yield k, int(v)
+
+
+def write_text(fp, items):
+    for k, v in items:
+        fp.write('%s\t%d\n' % (k, v))
+
+
+def read_binary(fp):
+    '''
+    read records of a binary count file.
+    @param fp binary file object positioned after MAGIC
+    '''
+    while True:
+        head = fp.read(_LENGTH.size)
+        if not head:
+            return
+        length, = _LENGTH.unpack(head)
+        k = fp.read(length).decode('utf-8')
+        v, = _COUNT.unpack(fp.read(_COUNT.size))
+        yield k, v
+
+
+def write_binary(fp, items):
+    '''
+    write a binary count file.
+    @param fp binary file object
+    @param items sorted iterable of (n-gram, count)
+    '''
+    fp.write(MAGIC)
+    for k, v in items:
+        k = k.encode('utf-8')
+        fp.write(_LENGTH.pack(len(k)) + k + _COUNT.pack(v))
+
+
+def read(path):
+    '''
+    read a count file of either format.
+    '''
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) == MAGIC:
+            yield from read_binary(fp)
+            return
+    with open(path) as fp:
+        yield from read_text(fp)
+
+
+def check_sorted(items, name):
+    '''
+    pass items through, raising ValueError if they are not sorted.
+    '''
+    prev = None
+    for k, v in items:
+        if prev is not None and k < prev:
+            raise ValueError('%s is not sorted: "%s" after "%s"' % (name, k, prev))
+        prev = k
+        yield k, v
+
+
+def merge(iterables):
+    '''
+    merge sorted iterables of (n-gram, count), summing counts of the same n-gram.
+    utf-8 preserves the order of code points, so str and bytes orders are the same.
+    '''
+    merged = heapq.merge(*iterables, key=lambda x: x[0])
+    for k, group in itertools.groupby(merged, key=lambda x: x[0]):
+        yield k, sum(v for _, v in group)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+'''
+byte ranges of text files split on line boundaries,
+which are processed in parallel by count_ngram.py and sharding.py.
+'''
+
+import os
+
+
+def split_ranges(path, k):
+    '''
+    split a file into k byte ranges on line boundaries.
+    some ranges are empty if the file has fewer lines than k.
+    returns list of (begin, end).
+    '''
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as fp:
+        for i in range(1, k):
+            fp.seek(max(size * i // k, offsets[-1]))
+            if fp.tell() > 0:
+                fp.seek(fp.tell() - 1)
+                fp.readline()
+            offsets.append(fp.tell())
+    offsets.append(size)
+    return list(zip(offsets, offsets[1:]))